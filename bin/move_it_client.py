@@ -64,6 +64,28 @@ For example::
 
 * 'publish_port' defines on which port to publish incomming files. 0 means random port.
 
+* A destination like 'zmq://thishost:9300/the/directory' makes the client
+  receive the files itself on port 9300, streamed by the server over zeromq,
+  so no ftp or ssh service is needed. 'zmq_credit' (default 16) is the number
+  of chunks the server may send ahead of what has been written to disk.
+  The files are written under 'ftp_root' (default '/') as for ftp
+  destinations. The port is bound on the 'zmq_interface' address (default
+  '*', all interfaces). There is no authentication: anyone who can reach the
+  port can write files in the destination directory, so restrict it to
+  trusted networks.
+
+* 'pull' can be set to True to download the files from the http server of
+  move_it_server chains having an 'http_port', instead of asking the server to
+  push them, so the server needs no credentials to the destination. Files
+  larger than 'pull_range_threshold' bytes (0, the default, means never) are
+  downloaded as 'pull_connections' (default 4) byte ranges in parallel. The
+  destination has to be a local directory.
+
+* Files announced with a checksum (see the 'checksum' option of
+  move_it_server) are checked against it, and discarded if they don't match:
+  while they are pulled or received over zeromq, and after they were pushed
+  to the destination, when it is on the client's host.
+
 Logging
 -------
 
@@ -52,4 +52,5 @@ setup(name="trollmoves",
                         'trollsift', 'netifaces',
                         'pyzmq', 'six',
                         'scp', 'paramiko'],
+      extras_require={'s3': ['boto3']},
       )
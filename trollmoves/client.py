@@ -30,11 +30,12 @@ import tarfile
 from collections import deque
 from six.moves.configparser import ConfigParser
 from threading import Lock, Thread, Event
+from six.moves.http_client import HTTPException
 from six.moves.urllib.parse import urlparse, urlunparse
 
 import netifaces
 import pyinotify
-from zmq import LINGER, POLLIN, REQ, Poller
+from zmq import LAST_ENDPOINT, LINGER, POLLIN, REQ, ROUTER, Poller
 
 from posttroll import get_context
 from posttroll.message import Message, MessageError
@@ -42,8 +43,11 @@ from posttroll.publisher import NoisyPublisher
 from posttroll.subscriber import Subscriber
 
 from trollmoves import heartbeat_monitor
-from trollmoves.utils import get_local_ips
-from trollmoves.utils import gen_dict_extract, translate_dict, translate_dict_value
+from trollmoves.utils import (ChecksumWriter, close_http_pools, file_checksum,
+                              file_signature, get_http_pool, get_local_ips,
+                              new_checksum, pack_signature, partial_name)
+from trollmoves.utils import (gen_dict_contains, gen_dict_extract,
+                              translate_dict, translate_dict_value)
 
 LOGGER = logging.getLogger(__name__)
 
@@ -231,6 +235,8 @@ def create_push_req_message(msg, destination, login):
     duri = urlparse(destination)
     scheme = duri.scheme or 'file'
     dest_hostname = duri.hostname or socket.gethostname()
+    if duri.port:
+        dest_hostname += ":" + str(duri.port)
     fake_req.data["destination"] = urlunparse((scheme, dest_hostname, duri.path, "", "", ""))
     if login:
         # if necessary add the credentials for the real request
@@ -310,13 +316,149 @@ def replace_mda(msg, kwargs):
     return msg
 
 
+def pull_ranges(pool, path, local_path, size, connections):
+    """Get *path* into *local_path* as parallel byte ranges."""
+    chunk_size = -(-size // connections)
+    errors = []
+
+    def pull_range(first):
+        last = min(first + chunk_size, size) - 1
+        try:
+            with open(local_path, 'r+b') as dst:
+                dst.seek(first)
+                response = pool.request(
+                    'GET', path, {'Range': 'bytes=%d-%d' % (first, last)},
+                    dst=dst)
+            if response.status != 206:
+                raise IOError("Can't get range %d-%d of %s: %d %s" % (
+                    first, last, path, response.status, response.reason))
+        except Exception as err:
+            errors.append(err)
+
+    threads = [Thread(target=pull_range, args=(first, ))
+               for first in range(0, size, chunk_size)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def pull_file(pool, path, local_path, connections=4, range_threshold=0,
+              checksum=None):
+    """Get *path* from the http server of *pool* into *local_path*.
+
+    Files larger than *range_threshold* (if not 0) are got as *connections*
+    byte ranges in parallel. If a *checksum* ('algorithm:hexdigest') is
+    given, the file has to match it. It is computed as the file is written,
+    except for files got as byte ranges, which are read again.
+    """
+    response = pool.request('HEAD', path)
+    if response.status != 200:
+        raise IOError("Can't get %s: %d %s" % (path, response.status,
+                                               response.reason))
+    size = int(response.getheader('Content-Length'))
+    tmp_path = partial_name(local_path)
+    received = None
+    try:
+        with open(tmp_path, 'wb') as dst:
+            if (range_threshold and size > range_threshold and
+                    connections > 1 and
+                    response.getheader('Accept-Ranges') == 'bytes'):
+                dst.truncate(size)
+                dst.close()
+                pull_ranges(pool, path, tmp_path, size, connections)
+                if checksum:
+                    received = file_checksum(tmp_path,
+                                             new_checksum(checksum).algorithm)
+            else:
+                if checksum:
+                    dst = ChecksumWriter(dst, new_checksum(checksum))
+                response = pool.request('GET', path, dst=dst)
+                if response.status != 200:
+                    raise IOError("Can't get %s: %d %s" % (
+                        path, response.status, response.reason))
+                if checksum:
+                    received = str(dst.checksum)
+        if os.path.getsize(tmp_path) != size:
+            raise IOError("Incomplete download of %s" % path)
+        if received != checksum:
+            raise IOError("Checksum mismatch for %s: %s instead of %s" % (
+                path, received, checksum))
+        os.rename(tmp_path, local_path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def pull_files(msg, local_dir, connections=4, range_threshold=0):
+    """Get the files of *msg* into *local_dir* from the sender's http server.
+
+    Files with a 'path' go to that subdirectory of *local_dir*, as they
+    would when pushed.
+    """
+    host, port = msg.data['http_address'].split(":")
+    pool = get_http_pool(host, int(port))
+    for var in gen_dict_contains(msg.data, 'uri'):
+        path = urlparse(var['uri']).path
+        local_path = os.path.join(local_dir, var.get('path', ''), var['uid'])
+        if not os.path.isdir(os.path.dirname(local_path)):
+            os.makedirs(os.path.dirname(local_path))
+        LOGGER.debug("Pulling %s from %s", path, msg.data['http_address'])
+        pull_file(pool, path, local_path, connections, range_threshold,
+                  var.get('checksum'))
+
+
+def check_pushed_files(msg, local_dir):
+    """Check the files of *msg* pushed to *local_dir* against their checksum.
+
+    Files that don't match are removed. Files not on this host, ie. pushed to
+    another one, can't be checked.
+    """
+    for var in gen_dict_contains(msg.data, 'checksum'):
+        if 'uid' not in var:
+            continue
+        local_path = os.path.join(local_dir, var.get('path', ''), var['uid'])
+        if not os.path.exists(local_path):
+            LOGGER.debug("Can't check %s, it is not on this host", local_path)
+            continue
+        checksum = var['checksum']
+        received = file_checksum(local_path, checksum.split(':', 1)[0])
+        if received != checksum:
+            os.remove(local_path)
+            raise IOError("Checksum mismatch for %s: %s instead of %s" % (
+                local_path, received, checksum))
+
+
 def request_push(msg, destination, login, publisher=None, unpack=None, delete=False, **kwargs):
+    pulled = False
     if already_received(msg):
         resend_if_local(msg, publisher)
         mtype = 'ack'
         req = Message(msg.subject, mtype, data=msg.data)
         LOGGER.debug("Sending: %s" % str(req))
         timeout = float(kwargs["req_timeout"])
+    elif (str(kwargs.get('pull', False)).lower() in ["1", "yes", "true", "on"]
+          and 'http_address' in msg.data):
+        local_dir = create_local_dir(destination, kwargs.get('ftp_root', '/'))
+        try:
+            pull_files(msg, local_dir,
+                       int(kwargs.get('pull_connections', 4)),
+                       int(kwargs.get('pull_range_threshold', 0)))
+        except (IOError, ValueError, HTTPException) as err:
+            LOGGER.error("Failed to pull files from %s: %s",
+                         msg.data['http_address'], str(err))
+            return
+        pulled = True
+        # Let the server know we have the files, eg. for deleting them.
+        mtype = 'ack'
+        req = Message(msg.subject, mtype, data=msg.data)
+        LOGGER.debug("Sending: %s" % str(req))
+        timeout = float(kwargs["req_timeout"])
     else:
         mtype = 'push'
         req, fake_req = create_push_req_message(msg, destination, login)
@@ -329,9 +471,19 @@ def request_push(msg, destination, login, publisher=None, unpack=None, delete=Fa
     hostname, port = msg.data["request_address"].split(":")
     requester = PushRequester(hostname, int(port))
     response = requester.send_and_recv(req, timeout=timeout)
+    if pulled and response and response.type == "ack":
+        response = Message(msg.subject, msg.type, data=response.data)
 
     if response and response.type in ['file', 'collection', 'dataset']:
         LOGGER.debug("Server done sending file")
+        if mtype == 'push':
+            # Pulled files are checked while downloading
+            try:
+                check_pushed_files(response, local_dir)
+            except (IOError, OSError, ValueError) as err:
+                LOGGER.error("Failed to push files from %s: %s",
+                             msg.data['request_address'], str(err))
+                return
         with cache_lock:
             for uid in gen_dict_extract(msg.data, 'uid'):
                 file_cache.append(uid)
@@ -378,11 +530,21 @@ def reload_config(filename, chains, callback=request_push, pub_instance=None):
 
             if "publisher" in chains[key]:
                 chains[key]["publisher"].stop()
+            if "receiver" in chains[key]:
+                chains[key]["receiver"].stop()
             for provider in chains[key]["providers"]:
                 chains[key]["listeners"][provider].stop()
                 del chains[key]["listeners"][provider]
 
         chains[key] = val
+        duri = urlparse(val["destination"])
+        if duri.scheme == 'zmq':
+            chains[key]["receiver"] = ZmqReceiver(
+                duri.port, duri.path,
+                credit=int(val.get("zmq_credit", 16)),
+                local_root=val.get("ftp_root", "/"),
+                interface=val.get("zmq_interface", "*"))
+            chains[key]["receiver"].start()
         try:
             chains[key]["publisher"] = NoisyPublisher("move_it_" + key,
                                                       val["publish_port"])
@@ -426,6 +588,8 @@ def reload_config(filename, chains, callback=request_push, pub_instance=None):
 
         if "publisher" in chains[key]:
             chains[key]["publisher"].stop()
+        if "receiver" in chains[key]:
+            chains[key]["receiver"].stop()
 
         del chains[key]
         LOGGER.debug("Removed " + key)
@@ -558,6 +722,171 @@ class EventHandler(pyinotify.ProcessEvent):
         self._fun(event.pathname)
 
 
+class ZmqReceiver(Thread):
+    """Receive the files streamed by the servers' zmq movers.
+
+    Only the paths under *root* are accepted, and they are written under
+    *local_root*, as for ftp destinations. Each sender is granted *credit*
+    chunks in advance, and one more for each chunk written to disk. Transfers
+    idle for more than *timeout* seconds are dropped. For delta transfers,
+    the checksums of the blocks of the existing copy are sent first, and the
+    new file is rebuilt from these blocks and the chunks received.
+
+    The port is bound on *interface* only. There is no authentication:
+    anyone who can reach it can write files under *root*.
+    """
+
+    # Methods handling the commands of the senders
+    commands = {b'signature': '_signature', b'open': '_open',
+                b'chunk': '_chunk', b'blocks': '_blocks', b'close': '_close'}
+
+    def __init__(self, port, root, credit=16, timeout=60, local_root='/',
+                 interface='*'):
+        super(ZmqReceiver, self).__init__()
+        self.root = os.path.abspath(root)
+        self.local_root = local_root
+        self.credit = credit
+        self.timeout = timeout
+        self.loop = True
+        self._socket = get_context().socket(ROUTER)
+        self._socket.setsockopt(LINGER, 0)
+        self._socket.bind("tcp://%s:%s" % (interface, str(port)))
+        self.port = int(self._socket.getsockopt_string(
+            LAST_ENDPOINT).rsplit(":", 1)[1])
+        self._transfers = {}
+
+    def run(self):
+        poller = Poller()
+        poller.register(self._socket, POLLIN)
+        while self.loop:
+            if dict(poller.poll(1000)).get(self._socket) == POLLIN:
+                frames = self._socket.recv_multipart(copy=False)
+                identity = frames[0].bytes
+                try:
+                    command = frames[1].bytes if len(frames) > 1 else b''
+                    if command not in self.commands:
+                        raise IOError("Unknown command %r" % command)
+                    handler = getattr(self, self.commands[command])
+                    reply = handler(identity, *frames[2:])
+                    self._socket.send_multipart([identity] + reply)
+                except Exception as err:
+                    LOGGER.error("Failed to receive file: %s", str(err))
+                    self._abort(identity)
+                    self._socket.send_multipart(
+                        [identity, b'error', str(err).encode('utf-8')])
+            self._drop_idle_transfers()
+        for identity in list(self._transfers):
+            self._abort(identity)
+        self._socket.close()
+
+    def _path(self, path):
+        path = os.path.abspath(path.bytes.decode('utf-8'))
+        if not path.startswith(self.root + os.path.sep):
+            raise IOError("%s is outside %s" % (path, self.root))
+        return os.path.join(*([self.local_root] + path.split(os.path.sep)))
+
+    def _signature(self, identity, path, block_size):
+        """Get the checksums of the blocks of the existing copy of *path*."""
+        try:
+            with open(self._path(path), 'rb') as file_obj:
+                signature = file_signature(file_obj, int(block_size.bytes))
+        except (IOError, OSError):
+            signature = []
+        return [b'signature', pack_signature(signature)]
+
+    def _open(self, identity, path, size, block_size=None, checksum=None):
+        """Start receiving *path*.
+
+        With a *block_size*, the file is rebuilt from blocks of the existing
+        copy of *path* and the chunks sent. With a *checksum*, the file
+        received has to match it.
+        """
+        path = self._path(path)
+        self._abort(identity)
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        block_size = block_size and int(block_size.bytes or 0)
+        basis = None
+        if block_size and os.path.exists(path):
+            basis = open(path, 'rb')
+        checksum = checksum and checksum.bytes.decode()
+        tmp_path = partial_name(path)
+        file_obj = open(tmp_path, 'wb')
+        if checksum:
+            file_obj = ChecksumWriter(file_obj, new_checksum(checksum))
+        self._transfers[identity] = [file_obj, tmp_path, path,
+                                     int(size.bytes), time.time(), basis,
+                                     block_size, checksum]
+        LOGGER.debug("Receiving %s", path)
+        return [b'credit', str(self.credit).encode()]
+
+    def _chunk(self, identity, data):
+        transfer = self._transfers[identity]
+        transfer[0].write(data.buffer)
+        transfer[4] = time.time()
+        return [b'credit', b'1']
+
+    def _blocks(self, identity, first, count):
+        """Copy *count* blocks from *first* on of the existing copy."""
+        transfer = self._transfers[identity]
+        basis, block_size = transfer[5:7]
+        if basis is None:
+            raise IOError("No existing copy of " + transfer[2])
+        basis.seek(int(first.bytes) * block_size)
+        length = int(count.bytes) * block_size
+        while length > 0:
+            data = basis.read(min(length, 1024 * 1024))
+            if not data:
+                break
+            transfer[0].write(data)
+            length -= len(data)
+        transfer[4] = time.time()
+        return [b'credit', b'1']
+
+    def _close(self, identity):
+        file_obj, tmp_path, path, size, _, basis, _, checksum = \
+            self._transfers.pop(identity)
+        file_obj.close()
+        if basis is not None:
+            basis.close()
+        if os.path.getsize(tmp_path) != size:
+            os.remove(tmp_path)
+            raise IOError("Size mismatch for " + path)
+        if checksum and str(file_obj.checksum) != checksum:
+            os.remove(tmp_path)
+            raise IOError("Checksum mismatch for " + path)
+        os.rename(tmp_path, path)
+        LOGGER.debug("Received %s", path)
+        return [b'done']
+
+    def _abort(self, identity):
+        try:
+            transfer = self._transfers.pop(identity)
+        except KeyError:
+            return
+        file_obj, tmp_path, basis = transfer[0], transfer[1], transfer[5]
+        file_obj.close()
+        if basis is not None:
+            basis.close()
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+    def _drop_idle_transfers(self):
+        now = time.time()
+        for identity, transfer in list(self._transfers.items()):
+            if now - transfer[4] > self.timeout:
+                LOGGER.warning("Dropping idle transfer of %s", transfer[2])
+                self._abort(identity)
+
+    def stop(self):
+        self.loop = False
+        if self.is_alive():
+            self.join()
+
+
 class StatCollector(object):
 
     def __init__(self, statfile):
@@ -574,6 +903,9 @@ def terminate(chains):
             listener.stop()
         if "publisher" in chain:
             chain["publisher"].stop()
+        if "receiver" in chain:
+            chain["receiver"].stop()
+    close_http_pools()
     LOGGER.info("Shutting down.")
     print("Thank you for using pytroll/move_it_client."
           " See you soon on pytroll.org!")
@@ -21,13 +21,18 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import base64
 import bz2
+import calendar
 import errno
+import fcntl
 import fnmatch
+import getpass
 import glob
 import logging
 import logging.handlers
 import os
+import re
 import shutil
 import subprocess
 import sys
@@ -35,26 +40,37 @@ import time
 import datetime
 import traceback
 import socket
+import stat
 import tempfile
+from email.utils import mktime_tz, parsedate_tz
+from functools import partial
+from xml.etree import ElementTree
 
 from six.moves.configparser import ConfigParser
 from ftplib import FTP, all_errors, error_perm
 from six.moves.queue import Empty, Queue
-from six.moves.urllib.parse import urlparse, urlunparse
-from six import string_types
-from collections import deque
-from threading import Thread, Event, current_thread, Lock
+from six.moves.urllib.parse import quote as quote_url
+from six.moves.urllib.parse import unquote, urlparse, urlunparse
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+from six import BytesIO, string_types
+from six.moves import shlex_quote as quote
+from collections import OrderedDict, deque
+from threading import Condition, Thread, Timer, Event, current_thread, Lock
 
 import pyinotify
-from zmq import NOBLOCK, POLLIN, PULL, PUSH, ROUTER, Poller, ZMQError
+from zmq import (DEALER, LINGER, NOBLOCK, POLLIN, PULL, PUSH, ROUTER, Poller,
+                 ZMQError)
 
 from posttroll import get_context
 from posttroll.message import Message
 from posttroll.publisher import get_own_ip
 from posttroll.subscriber import Subscribe
-from trollsift import globify, parse
+from trollsift import Parser, globify
 
-from trollmoves.utils import get_local_ips
+from trollmoves.utils import (DELTA_BLOCK_SIZE, Checksum, delta_ops,
+                              file_checksum, get_http_pool, get_local_ips,
+                              is_local_host, partial_name, unpack_signature)
 from trollmoves.utils import gen_dict_extract, gen_dict_contains
 
 LOGGER = logging.getLogger(__name__)
@@ -62,6 +78,137 @@ LOGGER = logging.getLogger(__name__)
 
 file_cache = deque(maxlen=61000)
 file_cache_lock = Lock()
+
+# Real paths of the files announced by each topic, for the http servers
+announced_files = OrderedDict()
+announced_files_lock = Lock()
+MAX_ANNOUNCED_FILES = 61000
+
+
+def remember_announced(topic, pathname, checksum=None):
+    """Remember that *pathname* was announced on *topic*, with *checksum*."""
+    key = (topic, os.path.realpath(pathname))
+    with announced_files_lock:
+        announced_files.pop(key, None)
+        announced_files[key] = checksum
+        while len(announced_files) > MAX_ANNOUNCED_FILES:
+            announced_files.popitem(last=False)
+
+
+def was_announced(topic, pathname):
+    """Check if *pathname* was announced on *topic*."""
+    with announced_files_lock:
+        return (topic, os.path.realpath(pathname)) in announced_files
+
+
+def announced_checksum(topic, pathname):
+    """Get the checksum *pathname* was announced with on *topic*, if any."""
+    with announced_files_lock:
+        return announced_files.get((topic, os.path.realpath(pathname)))
+
+
+# Original paths of the files picked up by each topic, to tell the files
+# missed by the watchers from the ones already handled (or being handled)
+detected_files = OrderedDict()
+detected_files_lock = Lock()
+
+
+def remember_detected(topic, pathname):
+    """Remember that *pathname* was picked up for *topic*."""
+    key = (topic, pathname)
+    with detected_files_lock:
+        detected_files.pop(key, None)
+        detected_files[key] = True
+        while len(detected_files) > MAX_ANNOUNCED_FILES:
+            detected_files.popitem(last=False)
+
+
+def forget_detected(topic, pathname):
+    """Forget that *pathname* was picked up for *topic*."""
+    with detected_files_lock:
+        detected_files.pop((topic, pathname), None)
+
+
+def was_detected(topic, pathname):
+    """Check if *pathname* was picked up, or announced, for *topic*."""
+    with detected_files_lock:
+        if (topic, pathname) in detected_files:
+            return True
+    announced_log = announced_logs.get(topic)
+    if announced_log is not None and pathname in announced_log:
+        return True
+    return was_announced(topic, pathname)
+
+
+class AnnouncedLog(object):
+    """Keep the original paths of the files announced on *topic* in
+    *filename*, one per line, for them to be known after a restart.
+
+    The latest paths are kept in memory too, for :func:`was_detected`. The
+    file is rewritten with only these when it grows too long.
+    """
+
+    def __init__(self, topic, filename):
+        self.topic = topic
+        self.filename = filename
+        self.lock = Lock()
+        self.lines = 0
+        self.pathnames = OrderedDict()
+        try:
+            with open(filename) as fd:
+                for line in fd:
+                    self._remember(line.rstrip('\n'))
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                LOGGER.warning("Could not read %s: %s", filename, str(err))
+            return
+        self.compact()
+
+    def _remember(self, pathname):
+        self.pathnames.pop(pathname, None)
+        self.pathnames[pathname] = True
+        while len(self.pathnames) > MAX_ANNOUNCED_FILES:
+            self.pathnames.popitem(last=False)
+
+    def __contains__(self, pathname):
+        with self.lock:
+            return pathname in self.pathnames
+
+    def add(self, pathname):
+        with self.lock:
+            self._remember(pathname)
+            try:
+                with open(self.filename, 'a') as fd:
+                    fd.write(pathname + '\n')
+            except IOError as err:
+                LOGGER.warning("Could not write to %s: %s", self.filename,
+                               str(err))
+                return
+            self.lines += 1
+            too_long = self.lines > 2 * MAX_ANNOUNCED_FILES
+        if too_long:
+            self.compact()
+
+    def compact(self):
+        """Rewrite the file with the paths kept in memory."""
+        with self.lock:
+            tmp_filename = self.filename + '.tmp'
+            try:
+                with open(tmp_filename, 'w') as fd:
+                    for pathname in self.pathnames:
+                        fd.write(pathname + '\n')
+                os.rename(tmp_filename, self.filename)
+            except (IOError, OSError) as err:
+                LOGGER.warning("Could not rewrite %s: %s", self.filename,
+                               str(err))
+                return
+            self.lines = len(self.pathnames)
+
+
+# Logs of the files announced, by topic
+announced_logs = {}
+
+
 START_TIME = datetime.datetime.utcnow()
 
 
@@ -113,6 +260,13 @@ class Deleter(Thread):
             self.timer.cancel()
 
 
+def origin_matchers(origin):
+    """Get the regexes matching the basename and real path of *origin* files."""
+    pattern = globify(origin)
+    return (re.compile(fnmatch.translate(os.path.basename(pattern))),
+            re.compile(fnmatch.translate(os.path.realpath(pattern))))
+
+
 class RequestManager(Thread):
     """Manage requests.
     """
@@ -131,6 +285,7 @@ class RequestManager(Thread):
         self._poller.register(self.out_socket, POLLIN)
         self._poller.register(self.in_socket, POLLIN)
         self._attrs = attrs
+        self._basename_matcher = self._path_matcher = None
         try:
             # Checking the validity of the file pattern
             _pattern = globify(attrs["origin"])
@@ -139,7 +294,20 @@ class RequestManager(Thread):
         except KeyError:
             if 'listen' not in attrs:
                 raise
+        else:
+            self._basename_matcher, self._path_matcher = origin_matchers(
+                attrs["origin"])
+        if 'checksum' in attrs:
+            try:
+                Checksum(attrs['checksum'])
+            except ValueError:
+                raise ConfigError('Unknown checksum algorithm: ' +
+                                  attrs['checksum'])
         self._deleter = Deleter()
+        self._http_server = None
+        if 'http_port' in attrs:
+            self._http_server = FileServer(int(attrs['http_port']),
+                                           self.is_servable)
 
         try:
             self._station = self._attrs["station"]
@@ -150,8 +318,30 @@ class RequestManager(Thread):
 
     def start(self):
         self._deleter.start()
+        if self._http_server is not None:
+            Thread(target=self._http_server.serve_forever).start()
         Thread.start(self)
 
+    def is_allowed(self, pathname):
+        """Check if *pathname* is a file clients may get from this chain."""
+        return (self._basename_matcher is None or
+                self._basename_matcher.match(os.path.basename(pathname))
+                is not None)
+
+    def is_servable(self, pathname):
+        """Check if *pathname* may be served over http.
+
+        Only files announced by this chain are, and for chains watching a
+        directory, their full path has to match the origin unless they were
+        unpacked.
+        """
+        realpath = os.path.realpath(pathname)
+        if not was_announced(self._attrs.get('topic'), realpath):
+            return False
+        if self._path_matcher is None or self._attrs.get('compression'):
+            return True
+        return self._path_matcher.match(realpath) is not None
+
     def pong(self, message):
         """Reply to ping
         """
@@ -165,9 +355,7 @@ class RequestManager(Thread):
             rel_path = the_dict.get('path', '')
             pathname = uri.path
             # FIXME: check against file_cache
-            if 'origin' in self._attrs and not fnmatch.fnmatch(
-                    os.path.basename(pathname),
-                    os.path.basename(globify(self._attrs["origin"]))):
+            if not self.is_allowed(pathname):
                 LOGGER.warning('Client trying to get invalid file: %s', pathname)
                 return Message(message.subject,
                                "err",
@@ -195,8 +383,17 @@ class RequestManager(Thread):
                           data=message.data.copy())
         new_msg.data['destination'] = clean_url(new_msg.data[
             'destination'])
+        self.add_checksums(new_msg.data)
         return new_msg
 
+    def add_checksums(self, data):
+        """Put the checksums the files were announced with in *data*."""
+        for the_dict in list(gen_dict_contains(data, 'uri')):
+            checksum = announced_checksum(self._attrs.get('topic'),
+                                          urlparse(the_dict['uri']).path)
+            if checksum is not None:
+                the_dict['checksum'] = checksum
+
     def ack(self, message):
         """Reply with ack to a publication
         """
@@ -204,9 +401,7 @@ class RequestManager(Thread):
             uri = urlparse(url)
             pathname = uri.path
 
-            if 'origin' in self._attrs and not fnmatch.fnmatch(
-                    os.path.basename(pathname),
-                    os.path.basename(globify(self._attrs["origin"]))):
+            if not self.is_allowed(pathname):
                 LOGGER.warning('Client trying to get invalid file: %s', pathname)
                 return Message(message.subject,
                                "err",
@@ -238,7 +433,14 @@ class RequestManager(Thread):
                     files.append(i)
                     if len(files) == max_count:
                         break
-        return Message(message.subject, "info", data={"files": files, "max_count": max_count, "uptime": str(uptime)})
+        data = {"files": files, "max_count": max_count, "uptime": str(uptime)}
+        try:
+            data["ingest"] = ingest_pipelines[self._attrs["topic"]].stats()
+        except (KeyError, TypeError):
+            pass
+        data["overflows"] = file_watcher.overflows
+        data["suppressed_events"] = file_watcher.suppressed
+        return Message(message.subject, "info", data=data)
 
     def unknown(self, message):
         """Reply to any unknown request.
@@ -310,10 +512,106 @@ class RequestManager(Thread):
         """Stop the request manager."""
         self._loop = False
         self._deleter.stop()
+        if self._http_server is not None:
+            self._http_server.shutdown()
+            self._http_server.server_close()
         self.out_socket.close(1)
         self.in_socket.close(1)
 
 
+def parse_byte_range(header, size):
+    """Parse the http Range *header* for a file of *size* bytes.
+
+    Return the first and last byte of the range, or None if the header
+    isn't a single byte range. ValueError is raised if the range can't be
+    satisfied.
+    """
+    unit, _, byte_range = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in byte_range:
+        return None
+    first, _, last = byte_range.strip().partition('-')
+    if first:
+        first = int(first)
+        last = min(int(last), size - 1) if last else size - 1
+    else:
+        # The last bytes of the file
+        first = max(size - int(last), 0)
+        last = size - 1
+    if first > last:
+        raise ValueError("Unsatisfiable range: " + header)
+    return first, last
+
+
+class FileRequestHandler(BaseHTTPRequestHandler):
+    """Serve the files of a chain, with keep-alive and byte ranges."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self.send_file(body=False)
+
+    def do_GET(self):
+        self.send_file(body=True)
+
+    def send_file(self, body=True):
+        pathname = unquote(urlparse(self.path).path)
+        try:
+            if not self.server.is_servable(pathname):
+                raise IOError("Not allowed")
+            file_obj = open(pathname, 'rb')
+        except IOError:
+            LOGGER.warning('Client trying to get invalid file: %s', pathname)
+            self.send_error(404)
+            return
+        with file_obj:
+            size = os.fstat(file_obj.fileno()).st_size
+            first, last = 0, size - 1
+            try:
+                byte_range = parse_byte_range(self.headers.get('Range', ''),
+                                              size)
+            except ValueError:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if byte_range is None:
+                self.send_response(200)
+            else:
+                first, last = byte_range
+                self.send_response(206)
+                self.send_header('Content-Range',
+                                 'bytes %d-%d/%d' % (first, last, size))
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(last - first + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+            if body and last >= first:
+                self.send_range(file_obj, first, last - first + 1)
+
+    def send_range(self, file_obj, offset, length):
+        """Send *length* bytes of *file_obj* from *offset*."""
+        if hasattr(self.connection, 'sendfile'):
+            self.connection.sendfile(file_obj, offset, length)
+        else:
+            file_obj.seek(offset)
+            shutil.copyfileobj(RangeReader(file_obj, length), self.wfile)
+
+    def log_message(self, fmt, *args):
+        LOGGER.debug("%s - " + fmt, self.address_string(), *args)
+
+
+class FileServer(ThreadingMixIn, HTTPServer):
+    """Http server for the files accepted by *is_servable*."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port, is_servable):
+        HTTPServer.__init__(self, ('', port), FileRequestHandler)
+        self.is_servable = is_servable
+
+
 class Listener(Thread):
 
     def __init__(self, attrs, publisher):
@@ -321,6 +619,8 @@ class Listener(Thread):
         self.attrs = attrs
         self.publisher = publisher
         self.loop = True
+        self.info = parse_info(attrs.get("info"))
+        self.addresses = chain_addresses(attrs)
 
     def run(self):
         with Subscribe('', topics=self.attrs['listen'], addr_listener=True) as sub:
@@ -342,25 +642,23 @@ class Listener(Thread):
 
                     #pathname = unpack(orig_pathname, **attrs)
 
-                    info = self.attrs.get("info", {})
-                    if info:
-                        info = dict((elt.strip().split('=') for elt in info.split(";")))
-                        for infokey, infoval in info.items():
-                            if "," in infoval:
-                                info[infokey] = infoval.split(",")
+                    info = dict(self.info)
 
                     # info.update(parse(attrs["origin"], orig_pathname))
                     # info['uri'] = pathname
                     # info['uid'] = os.path.basename(pathname)
                     info.update(msg.data)
-                    info['request_address'] = self.attrs.get(
-                        "request_address", get_own_ip()) + ":" + self.attrs["request_port"]
+                    info.update(self.addresses)
                     old_data = msg.data
                     msg = Message(self.attrs["topic"], msg.type, info)
                     self.publisher.send(str(msg))
                     with file_cache_lock:
                         for filename in gen_dict_extract(old_data, 'uid'):
                             file_cache.appendleft(self.attrs["topic"] + '/' + filename)
+                    for the_dict in gen_dict_contains(old_data, 'uri'):
+                        remember_announced(self.attrs["topic"],
+                                           urlparse(the_dict['uri']).path,
+                                           the_dict.get('checksum'))
                     LOGGER.debug("Message sent: " + str(msg))
                     if not self.loop:
                         break
@@ -369,6 +667,28 @@ class Listener(Thread):
         self.loop = False
 
 
+def parse_info(info):
+    """Parse the 'info' option: ';' separated 'key=value' items.
+
+    Values with commas are split into lists.
+    """
+    res = {}
+    if info:
+        for elt in info.split(";"):
+            key, val = elt.strip().split('=')
+            res[key] = val.split(",") if "," in val else val
+    return res
+
+
+def chain_addresses(attrs):
+    """Get the addresses announced for the files of the chain *attrs*."""
+    host = attrs.get("request_address", get_own_ip())
+    addresses = {'request_address': host + ":" + attrs["request_port"]}
+    if 'http_port' in attrs:
+        addresses['http_address'] = host + ":" + attrs["http_port"]
+    return addresses
+
+
 def create_posttroll_notifier(attrs, publisher):
     """Create a notifier listening to posttroll messages from *attrs*.
     """
@@ -377,50 +697,831 @@ def create_posttroll_notifier(attrs, publisher):
     return listener, None
 
 
-def create_file_notifier(attrs, publisher):
-    """Create a notifier from the specified configuration attributes *attrs*.
+# Number of seconds during which the events about a file are merged
+COALESCE_TIME = 1.0
+
+
+class SharedWatcher(object):
+    """One inotify instance for all the chains watching for files.
+
+    Each directory is watched once, and its events are passed only to the
+    callbacks registered for it with a matching pattern.
+
+    Directories can also be watched for the subdirectories created and
+    removed in them.
+
+    When the kernel queue of events overflows, the events lost can't be
+    known, so the watched directories are rescanned for the files their
+    chains don't know about yet, which are then passed to the callbacks. The
+    files modified recently are given some time to get an event of their
+    own, not to be picked up while still being written.
+    """
+
+    mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO |
+            pyinotify.IN_CREATE)
+    subdir_mask = (pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO |
+                   pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM)
+
+    def __init__(self):
+        self.lock = Lock()
+        self.manager = None
+        self.notifier = None
+        # Watch descriptors and masks of the directories
+        self.watches = {}
+        self.masks = {}
+        # (pattern, callback, compiled pattern, known) of the directories
+        self.callbacks = {}
+        # Callbacks for the subdirectories of the directories
+        self.subdir_callbacks = {}
+        self.overflows = 0
+        self.handler = None
+
+    @property
+    def suppressed(self):
+        """Number of duplicate events dropped."""
+        return self.handler.suppressed if self.handler else 0
+
+    def add(self, dirname, pattern, fun, known=None):
+        """Call *fun* for the files matching *pattern* in *dirname*.
+
+        *known* tells if a file was already handled, for rescans.
+        """
+        with self.lock:
+            self.callbacks.setdefault(dirname, []).append(
+                (pattern, fun, re.compile(fnmatch.translate(pattern)), known))
+            self._update_watch(dirname)
+
+    def add_subdirs(self, dirname, fun):
+        """Call *fun* with the path of the subdirectories created in (with
+        True) or removed from (with False) *dirname*."""
+        with self.lock:
+            self.subdir_callbacks.setdefault(dirname, []).append(fun)
+            self._update_watch(dirname)
+
+    def remove_subdirs(self, dirname, fun):
+        """Stop calling *fun* for the subdirectories of *dirname*."""
+        with self.lock:
+            callbacks = self.subdir_callbacks.get(dirname, [])
+            if fun not in callbacks:
+                return
+            callbacks.remove(fun)
+            if not callbacks:
+                del self.subdir_callbacks[dirname]
+            self._update_watch(dirname)
+
+    def _update_watch(self, dirname):
+        """Watch *dirname* for the events its callbacks need, if any."""
+        if self.notifier is None:
+            self.manager = pyinotify.WatchManager()
+            self.handler = EventHandler(self.dispatch,
+                                        overflow=self.overflow,
+                                        coalesce=COALESCE_TIME,
+                                        subdirs=self.dispatch_subdir)
+            self.notifier = pyinotify.ThreadedNotifier(self.manager,
+                                                       self.handler)
+            self.notifier.daemon = True
+            self.notifier.start()
+        mask = 0
+        if dirname in self.callbacks:
+            mask |= self.mask
+        if dirname in self.subdir_callbacks:
+            mask |= self.subdir_mask
+        if mask == self.masks.get(dirname, 0):
+            return
+        if not mask:
+            del self.masks[dirname]
+            self.manager.rm_watch(self.watches.pop(dirname))
+        elif dirname in self.watches:
+            self.manager.update_watch(self.watches[dirname], mask)
+            self.masks[dirname] = mask
+        else:
+            wd = self.manager.add_watch(dirname, mask)[dirname]
+            if wd < 0:
+                LOGGER.error("Could not watch %s", dirname)
+            else:
+                self.watches[dirname] = wd
+                self.masks[dirname] = mask
+
+    def remove(self, dirname, pattern, fun):
+        """Stop calling *fun* for the files of *dirname*."""
+        with self.lock:
+            callbacks = self.callbacks.get(dirname, [])
+            for callback in callbacks:
+                if callback[:2] == (pattern, fun):
+                    callbacks.remove(callback)
+                    break
+            else:
+                return
+            if not callbacks:
+                del self.callbacks[dirname]
+            self._update_watch(dirname)
+
+    def dispatch(self, pathname):
+        """Pass the event about *pathname* to the chains waiting for it."""
+        with self.lock:
+            callbacks = list(self.callbacks.get(os.path.dirname(pathname),
+                                                []))
+        for pattern, fun, matcher, known in callbacks:
+            if matcher.match(pathname):
+                try:
+                    fun(pathname)
+                except Exception:
+                    LOGGER.exception("Could not process %s:", pathname)
+
+    def dispatch_subdir(self, pathname, created):
+        """Pass the creation or removal of the directory *pathname* on."""
+        with self.lock:
+            callbacks = list(self.subdir_callbacks.get(
+                os.path.dirname(pathname), []))
+        for fun in callbacks:
+            try:
+                fun(pathname, created)
+            except Exception:
+                LOGGER.exception("Could not process %s:", pathname)
+
+    def overflow(self):
+        """Rescan the watched directories after events were lost."""
+        with self.lock:
+            self.overflows += 1
+            overflows = self.overflows
+        LOGGER.warning("Inotify queue overflow (%d so far), rescanning",
+                       overflows)
+        # Not to lose even more events while scanning
+        rescan = Thread(target=self.rescan)
+        rescan.daemon = True
+        rescan.start()
+
+    def rescan(self):
+        """Pass the files of the watched directories that are not known yet
+        to the chains waiting for them."""
+        with self.lock:
+            callbacks = dict((dirname, list(dir_callbacks))
+                             for dirname, dir_callbacks
+                             in self.callbacks.items())
+            subdir_callbacks = dict((dirname, list(dir_callbacks))
+                                    for dirname, dir_callbacks
+                                    in self.subdir_callbacks.items())
+        # The directories created meanwhile are scanned when added
+        for dirname, dir_callbacks in subdir_callbacks.items():
+            for name, pathname, is_file in scan_entries(dirname):
+                if os.path.isdir(pathname):
+                    for fun in dir_callbacks:
+                        fun(pathname, True)
+        missed = 0
+        recent = []
+        for dirname, dir_callbacks in callbacks.items():
+            for pathname in scan_files(dirname):
+                for pattern, fun, matcher, known in dir_callbacks:
+                    if not matcher.match(pathname):
+                        continue
+                    if known is not None and known(pathname):
+                        continue
+                    if not is_settled(pathname):
+                        # Maybe still being written, its closing will tell
+                        recent.append((pathname, fun, known))
+                        continue
+                    missed += 1
+                    self.call(fun, pathname)
+        if recent:
+            # Unless it was lost too
+            time.sleep(SETTLE_TIME)
+            for pathname, fun, known in recent:
+                if ((known is None or not known(pathname)) and
+                        is_settled(pathname)):
+                    missed += 1
+                    self.call(fun, pathname)
+        LOGGER.info("Rescan done, %d files were missed", missed)
+        return missed
+
+    @staticmethod
+    def call(fun, pathname):
+        try:
+            fun(pathname)
+        except Exception:
+            LOGGER.exception("Could not process %s:", pathname)
+
+    def stop(self):
+        """Stop the inotify thread."""
+        with self.lock:
+            notifier, self.notifier = self.notifier, None
+            self.watches.clear()
+            self.masks.clear()
+            self.callbacks.clear()
+            self.subdir_callbacks.clear()
+        if notifier is not None:
+            notifier.stop()
+
+
+# Number of seconds after which a file not modified is deemed complete
+SETTLE_TIME = 5
+
+
+def is_settled(pathname):
+    """Check if *pathname* was not modified for a while."""
+    try:
+        return os.stat(pathname).st_mtime < time.time() - SETTLE_TIME
+    except OSError:
+        return False
+
+
+def scan_entries(dirname):
+    """Get the name and path of the entries of *dirname*, with a function
+    telling if they are regular files."""
+    try:
+        scandir = os.scandir
+    except AttributeError:
+        # python 2
+        try:
+            names = os.listdir(dirname)
+        except OSError as err:
+            LOGGER.warning("Could not scan %s: %s", dirname, str(err))
+            return
+        for name in names:
+            pathname = os.path.join(dirname, name)
+            yield name, pathname, partial(os.path.isfile, pathname)
+        return
+    try:
+        entries = scandir(dirname)
+    except OSError as err:
+        LOGGER.warning("Could not scan %s: %s", dirname, str(err))
+        return
+    for entry in entries:
+        yield entry.name, entry.path, partial(entry_is_file, entry)
+
+
+def entry_is_file(entry):
+    """Check if the scandir *entry* is a regular file."""
+    try:
+        return entry.is_file()
+    except OSError:
+        return False
+
+
+def scan_files(dirname):
+    """Get the paths of the regular files in *dirname*."""
+    for name, pathname, is_file in scan_entries(dirname):
+        if is_file():
+            yield pathname
+
+
+file_watcher = SharedWatcher()
+
+
+class StageStats(object):
+    """Number of files that went through a stage, and the time it took."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.lock = Lock()
+
+    def add(self, elapsed):
+        with self.lock:
+            self.count += 1
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+
+    def as_dict(self, depth):
+        with self.lock:
+            return {'depth': depth, 'count': self.count,
+                    'mean_time': self.total_time / max(self.count, 1),
+                    'max_time': self.max_time}
+
+
+class IngestPipeline(object):
+    """Handle the files detected by a chain in stages, off the event thread.
+
+    The files are queued for *workers* threads running *process* on them,
+    eg. unpacking them, a file always going to the same thread so that the
+    events about it are handled in order. What *process* returns is then
+    passed to *publish* by a thread of its own. The stats of each stage, the
+    files waiting and the time from their detection until they leave the
+    stage, are given by :meth:`stats`.
+
+    The *aggregator* the files may be gathered in by *publish* is started
+    and stopped with the pipeline. The files still waiting to be processed
+    when stopping are passed to *dropped*.
+    """
+
+    def __init__(self, process, publish, workers=4, aggregator=None,
+                 dropped=None):
+        self.process = process
+        self.publish = publish
+        self.aggregator = aggregator
+        self.dropped = dropped
+        self.queues = [Queue() for _ in range(workers)]
+        self.publish_queue = Queue()
+        self.process_stats = StageStats()
+        self.publish_stats = StageStats()
+        self.threads = []
+
+    def start(self):
+        self.threads = [Thread(target=self.run_process, args=(queue, ))
+                        for queue in self.queues]
+        self.threads.append(Thread(target=self.run_publish))
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+        if self.aggregator is not None:
+            self.aggregator.start()
+
+    def add(self, pathname):
+        """Queue the file *pathname* for processing."""
+        queue = self.queues[hash(pathname) % len(self.queues)]
+        queue.put((pathname, time.time()))
+
+    def run_process(self, queue):
+        while True:
+            job = queue.get()
+            if job is None:
+                # Woken up to stop
+                break
+            pathname, detected = job
+            try:
+                result = self.process(pathname)
+            except Exception:
+                LOGGER.exception("Could not process %s:", pathname)
+                continue
+            self.process_stats.add(time.time() - detected)
+            if result is not None:
+                self.publish_queue.put((result, detected))
+
+    def run_publish(self):
+        while True:
+            job = self.publish_queue.get()
+            if job is None:
+                break
+            result, detected = job
+            try:
+                self.publish(*result)
+            except Exception:
+                LOGGER.exception("Could not publish %s:", str(result[0]))
+                continue
+            self.publish_stats.add(time.time() - detected)
+
+    def stop(self, wait=False):
+        """Stop the threads, once the files being processed are published.
+
+        The files waiting are dropped, unless *wait* is True.
+        """
+        dropped = []
+        for queue in self.queues:
+            while not wait:
+                try:
+                    job = queue.get_nowait()
+                except Empty:
+                    break
+                if job is not None:
+                    dropped.append(job[0])
+            queue.put(None)
+        if dropped:
+            LOGGER.info("Dropping %d files not processed yet", len(dropped))
+            if self.dropped is not None:
+                for pathname in dropped:
+                    self.dropped(pathname)
+        for thread in self.threads[:-1]:
+            thread.join()
+        if self.threads:
+            self.publish_queue.put(None)
+            self.threads[-1].join()
+        self.threads = []
+        if self.aggregator is not None:
+            self.aggregator.stop()
+
+    def stats(self):
+        """Get the depth of the queues and the latency of each stage."""
+        stats = {'process': self.process_stats.as_dict(
+                     sum(queue.qsize() for queue in self.queues)),
+                 'publish': self.publish_stats.as_dict(
+                     self.publish_queue.qsize())}
+        if self.aggregator is not None:
+            stats['aggregate'] = self.aggregator.stats()
+        return stats
+
+
+class Aggregator(object):
+    """Gather the files announced by a chain into datasets, the files with the
+    same values for *keys* going together.
+
+    A dataset is passed to *send* once it has *count* files (0 for no
+    limit), or *timeout* seconds after its first file came.
+    """
+
+    def __init__(self, keys, send, count=0, timeout=60):
+        self.keys = keys
+        self.send = send
+        self.count = count
+        self.timeout = timeout
+        # Deadline and infos of the files of the datasets being gathered
+        self.slots = OrderedDict()
+        self.sent = 0
+        self.lock = Lock()
+        self.loop = Event()
+        self.thread = None
+
+    def start(self):
+        self.loop.clear()
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, info):
+        """Add the file described by *info* to its dataset."""
+        key = tuple(str(info.get(name)) for name in self.keys)
+        with self.lock:
+            if key not in self.slots:
+                self.slots[key] = (time.time() + self.timeout, [])
+            files = self.slots[key][1]
+            # A file announced again replaces the previous one
+            files[:] = [the_file for the_file in files
+                        if the_file['uid'] != info['uid']]
+            files.append(info)
+            if not self.count or len(files) < self.count:
+                return
+            del self.slots[key]
+        self.send_dataset(files)
+
+    def send_dataset(self, files):
+        with self.lock:
+            self.sent += 1
+        self.send(dataset_info(files))
+
+    def run(self):
+        while not self.loop.is_set():
+            self.loop.wait(min(self.timeout, 1))
+            self.flush(time.time())
+
+    def flush(self, now=None):
+        """Send the datasets timed out at *now*, or all of them."""
+        expired = []
+        with self.lock:
+            for key, (deadline, files) in list(self.slots.items()):
+                if now is not None and deadline > now:
+                    # The slots are in the order of their deadlines
+                    break
+                del self.slots[key]
+                expired.append(files)
+        for files in expired:
+            if self.count:
+                LOGGER.warning("Sending an incomplete dataset: %d files "
+                               "out of %d", len(files), self.count)
+            self.send_dataset(files)
+
+    def stats(self):
+        with self.lock:
+            return {'pending': len(self.slots),
+                    'files': sum(len(files) for deadline, files
+                                 in self.slots.values()),
+                    'sent': self.sent}
+
+    def stop(self):
+        """Stop, sending the datasets gathered so far."""
+        self.loop.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+
+def dataset_info(files):
+    """Make the info of a dataset message from the infos of *files*.
+
+    Only the metadata shared by all the files are kept, the files being
+    listed in 'dataset'.
     """
+    files = sorted(files, key=lambda the_file: the_file['uid'])
+    info = {}
+    for key, val in files[0].items():
+        if key in ('uri', 'uid', 'checksum'):
+            continue
+        if all(the_file.get(key) == val for the_file in files[1:]):
+            info[key] = val
+    info['dataset'] = [dict((key, the_file[key])
+                            for key in ('uri', 'uid', 'checksum')
+                            if key in the_file)
+                       for the_file in files]
+    return info
+
+
+# Ingest pipelines of the chains, by topic
+ingest_pipelines = {}
+
+
+class FileWatch(object):
+    """Handle on the watching of *dirname* for files matching *pattern*.
+
+    The files are passed to *fun*, and handled by *pipeline*. If *dirname*
+    has wildcards, eg. for dated directories, the directories matching it are
+    watched as they are created, and forgotten when removed. Only the
+    directories on the way to them are watched for that.
+    """
+
+    def __init__(self, dirname, pattern, fun, pipeline, watcher=file_watcher,
+                 known=None):
+        self.dirname = dirname
+        self.pattern = pattern
+        self.fun = fun
+        self.pipeline = pipeline
+        self.watcher = watcher
+        self.known = known
+        self.root, self.levels = split_dir_pattern(dirname)
+        self.lock = Lock()
+        # Depth of the directories watched for subdirectories, and the
+        # directories watched for files
+        self.parents = {}
+        self.leaves = set()
+
+    def start(self):
+        self.pipeline.start()
+        with self.lock:
+            self.add_dir(self.root, 0, False)
+
+    def add_dir(self, dirname, depth, scan):
+        """Watch *dirname*, *depth* levels below the root, and the matching
+        directories in it. With *scan*, the files already there and not
+        known yet are passed on."""
+        if depth == len(self.levels):
+            if dirname in self.leaves:
+                return
+            self.leaves.add(dirname)
+            self.watcher.add(dirname, self.pattern, self.fun, self.known)
+            if scan:
+                self.check_files(scan_files(dirname))
+            return
+        if dirname in self.parents:
+            return
+        self.parents[dirname] = depth
+        self.watcher.add_subdirs(dirname, self.subdir_event)
+        for name, pathname, is_file in scan_entries(dirname):
+            if self.levels[depth].match(name) and os.path.isdir(pathname):
+                self.add_dir(pathname, depth + 1, scan)
+
+    def check_files(self, pathnames, last_check=False):
+        """Pass on the files of *pathnames* not known yet.
+
+        The files modified recently may be still being written, so they are
+        left to their closing event, and checked again a bit later in case
+        they were closed before their directory was watched.
+        """
+        recent = []
+        for pathname in pathnames:
+            if self.known is not None and self.known(pathname):
+                continue
+            if is_settled(pathname):
+                self.fun(pathname)
+            elif not last_check:
+                recent.append(pathname)
+        if recent:
+            timer = Timer(SETTLE_TIME, self.check_files, (recent, True))
+            timer.daemon = True
+            timer.start()
+
+    def subdir_event(self, pathname, created):
+        """Follow the creation or removal of the directory *pathname*."""
+        with self.lock:
+            depth = self.parents.get(os.path.dirname(pathname))
+            if depth is None:
+                return
+            if not created:
+                self.remove_dirs(pathname)
+            elif self.levels[depth].match(os.path.basename(pathname)):
+                LOGGER.debug("Watching the new directory %s", pathname)
+                self.add_dir(pathname, depth + 1, True)
+
+    def remove_dirs(self, top=None):
+        """Stop watching *top* and the directories below, or all of them."""
+        def is_below(dirname):
+            return (top is None or dirname == top or
+                    dirname.startswith(top.rstrip(os.sep) + os.sep))
+        for dirname in [leaf for leaf in self.leaves if is_below(leaf)]:
+            self.leaves.remove(dirname)
+            self.watcher.remove(dirname, self.pattern, self.fun)
+        for dirname in [parent for parent in self.parents if is_below(parent)]:
+            del self.parents[dirname]
+            self.watcher.remove_subdirs(dirname, self.subdir_event)
+
+    def stop(self):
+        with self.lock:
+            self.remove_dirs()
+        self.pipeline.stop()
+
+
+def split_dir_pattern(dirname):
+    """Split the directory pattern *dirname* into the directory without
+    wildcards it starts with, and the compiled patterns of the names of the
+    directories below it."""
+    parts = dirname.split(os.sep)
+    for i, part in enumerate(parts):
+        if re.search('[*?[]', part):
+            break
+    else:
+        return dirname, []
+    root = os.sep.join(parts[:i]) or os.sep
+    return root, [re.compile(fnmatch.translate(part)) for part in parts[i:]]
+
+
+class PollWatch(Thread):
+    """Poll *dirname* for files matching *pattern*, for the filesystems
+    inotify doesn't see all the changes of (eg. nfs).
+
+    The files are passed to *fun* once complete, ie. when their size and
+    modification time didn't change between two polls, and handled by
+    *pipeline*. The files already there when starting are left to the
+    backlog. The directory is listed again only when it changed, and then
+    only the new files are looked at, so polling big directories is cheap.
+    The polls are every *interval* seconds while files come, getting further
+    apart up to *max_interval* seconds otherwise.
+    """
+
+    def __init__(self, dirname, pattern, fun, pipeline, interval=1.0,
+                 max_interval=30.0):
+        super(PollWatch, self).__init__()
+        self.daemon = True
+        self.dirname = dirname
+        self.fun = fun
+        self.pipeline = pipeline
+        self.matcher = re.compile(fnmatch.translate(pattern))
+        self.min_interval = interval
+        self.max_interval = max(interval, max_interval)
+        self.interval = interval
+        self.loop = Event()
+        # Names of the directory's entries, and (size, mtime) of the files
+        # not complete yet
+        self.names = None
+        self.pending = {}
+        self.dir_mtime = None
+        self.last_listing = 0
+
+    def start(self):
+        self.pipeline.start()
+        super(PollWatch, self).start()
+
+    def run(self):
+        while not self.loop.is_set():
+            try:
+                changed = self.poll()
+            except Exception:
+                LOGGER.exception("Could not poll %s:", self.dirname)
+                changed = False
+            if changed:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * 2, self.max_interval)
+            self.loop.wait(self.interval)
+
+    def poll(self):
+        """Look for new and complete files, tell if anything changed."""
+        try:
+            dir_mtime = os.stat(self.dirname).st_mtime
+        except OSError as err:
+            LOGGER.warning("Could not poll %s: %s", self.dirname, str(err))
+            return False
+        changed = False
+        # The mtime of the directory may be too coarse to tell apart the
+        # changes made within a second of the last listing
+        if (self.names is None or dir_mtime != self.dir_mtime or
+                dir_mtime >= self.last_listing - 1):
+            self.last_listing = time.time()
+            self.dir_mtime = dir_mtime
+            changed = self.list_dir()
+        for name, state in list(self.pending.items()):
+            pathname = os.path.join(self.dirname, name)
+            try:
+                stats = os.stat(pathname)
+            except OSError:
+                del self.pending[name]
+                continue
+            new_state = (stats.st_size, stats.st_mtime)
+            if new_state == state:
+                del self.pending[name]
+                self.fun(pathname)
+            else:
+                self.pending[name] = new_state
+            changed = True
+        return changed
+
+    def list_dir(self):
+        """Update the names in the directory, tell if there are new ones."""
+        names = set()
+        new = False
+        for name, pathname, is_file in scan_entries(self.dirname):
+            names.add(name)
+            if self.names is None or name in self.names:
+                continue
+            new = True
+            if self.matcher.match(pathname) and is_file():
+                self.pending[name] = None
+        for name in list(self.pending):
+            if name not in names:
+                del self.pending[name]
+        self.names = names
+        return new
+
+    def stop(self):
+        self.loop.set()
+        if self.is_alive():
+            self.join()
+        self.pipeline.stop()
 
-    tmask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO |
-             pyinotify.IN_CREATE)
 
-    wm_ = pyinotify.WatchManager()
+def create_file_notifier(attrs, publisher):
+    """Create a notifier from the specified configuration attributes *attrs*.
+
+    The files are watched for by the shared inotify watcher, or by polling
+    when 'watcher' is 'poll', once the notifier is started.
+    """
 
     pattern = globify(attrs["origin"])
     opath = os.path.dirname(pattern)
+    if (attrs.get('watcher', 'inotify') == 'poll' and
+            re.search('[*?[]', opath)):
+        raise ConfigError("Polled directory can't have patterns: " + opath)
+
+    # Everything not depending on the file is prepared once
+    matcher = re.compile(fnmatch.translate(pattern))
+    parser = Parser(attrs["origin"])
+    chain_info = parse_info(attrs.get("info"))
+    addresses = chain_addresses(attrs)
+    if "backlog_cache" in attrs:
+        announced_log = AnnouncedLog(attrs["topic"], attrs["backlog_cache"])
+        announced_logs[attrs["topic"]] = announced_log
+    else:
+        announced_log = None
+        announced_logs.pop(attrs["topic"], None)
 
     def fun(orig_pathname):
-        """Publish what we have."""
-        if not fnmatch.fnmatch(orig_pathname, pattern):
+        """Queue the file for publication if it matches."""
+        if not matcher.match(orig_pathname):
             return
         else:
             LOGGER.debug('We have a match: %s', orig_pathname)
+        remember_detected(attrs["topic"], orig_pathname)
+        pipeline.add(orig_pathname)
 
-        pathname = unpack(orig_pathname, **attrs)
+    def known(orig_pathname):
+        return was_detected(attrs["topic"], orig_pathname)
 
-        info = attrs.get("info", {})
-        if info:
-            info = dict((elt.strip().split('=') for elt in info.split(";")))
-            for infokey, infoval in info.items():
-                if "," in infoval:
-                    info[infokey] = infoval.split(",")
+    def process(orig_pathname):
+        """Get the file ready and describe it."""
+        pathname = unpack(orig_pathname, **attrs)
 
-        info.update(parse(attrs["origin"], orig_pathname))
+        info = dict(chain_info)
+        info.update(parser.parse(orig_pathname))
         info['uri'] = pathname
         info['uid'] = os.path.basename(pathname)
-        info['request_address'] = attrs.get(
-            "request_address", get_own_ip()) + ":" + attrs["request_port"]
-        msg = Message(attrs["topic"], 'file', info)
-        publisher.send(str(msg))
+        info.update(addresses)
+        if 'checksum' in attrs:
+            # The file is most likely still in the page cache
+            try:
+                info['checksum'] = file_checksum(pathname, attrs['checksum'])
+            except (IOError, OSError) as err:
+                LOGGER.error("Could not checksum %s: %s", pathname, str(err))
+                return None
+        return pathname, info, orig_pathname
+
+    def publish(pathname, info, orig_pathname):
+        """Publish what we have."""
         with file_cache_lock:
             file_cache.appendleft(attrs["topic"] + '/' + info["uid"])
-        LOGGER.debug("Message sent: " + str(msg))
-
-    tnotifier = pyinotify.ThreadedNotifier(wm_, EventHandler(fun))
+        remember_announced(attrs["topic"], pathname, info.get('checksum'))
+        if announced_log is not None:
+            announced_log.add(orig_pathname)
+        if aggregator is not None:
+            aggregator.add(info)
+        else:
+            send('file', info)
 
-    wm_.add_watch(opath, tmask)
+    def send(msg_type, info):
+        msg = Message(attrs["topic"], msg_type, info)
+        publisher.send(str(msg))
+        LOGGER.debug("Message sent: " + str(msg))
 
-    return tnotifier, fun
+    if attrs.get('aggregate_keys'):
+        keys = [key.strip() for key in attrs['aggregate_keys'].split(',')]
+        for key in keys:
+            if key not in parser.keys() and key not in chain_info:
+                LOGGER.warning("%s is not in the origin nor in the info of "
+                               "%s", key, attrs["topic"])
+        aggregator = Aggregator(keys, partial(send, 'dataset'),
+                                int(attrs.get('aggregate_count', 0)),
+                                float(attrs.get('aggregate_timeout', 60)))
+    else:
+        aggregator = None
+
+    pipeline = IngestPipeline(process, publish,
+                              int(attrs.get('ingest_workers', 4)),
+                              aggregator,
+                              partial(forget_detected, attrs["topic"]))
+    ingest_pipelines[attrs["topic"]] = pipeline
+
+    if attrs.get('watcher', 'inotify') == 'poll':
+        watch = PollWatch(opath, pattern, fun, pipeline,
+                          float(attrs.get('poll_interval', 1)),
+                          float(attrs.get('poll_max_interval', 30)))
+    else:
+        watch = FileWatch(opath, pattern, fun, pipeline, known=known)
+    return watch, fun
 
 
 def clean_url(url):
@@ -487,7 +1588,7 @@ def reload_config(filename,
 
     new_chains = read_config(filename)
 
-    old_glob = []
+    backlogs = []
 
     for key, val in new_chains.items():
         identical = True
@@ -501,6 +1602,8 @@ def reload_config(filename,
             if identical:
                 continue
 
+            if "backlog" in chains[key]:
+                chains[key]["backlog"].stop()
             chains[key]["notifier"].stop()
             if "request_manager" in chains[key]:
                 chains[key]["request_manager"].stop()
@@ -526,11 +1629,22 @@ def reload_config(filename,
             elif 'listen' in val:
                 notifier_builder = create_posttroll_notifier
 
-        chains[key]["notifier"], fun = notifier_builder(val, publisher)
+        try:
+            chains[key]["notifier"], fun = notifier_builder(val, publisher)
+        except ConfigError as err:
+            LOGGER.error('Invalid config parameters in %s: %s', key, str(err))
+            LOGGER.warning('Remove and skip %s', key)
+            chains[key]["request_manager"].stop()
+            del chains[key]
+            continue
         chains[key]["request_manager"].start()
         chains[key]["notifier"].start()
-        if 'origin' in val:
-            old_glob.append((globify(val["origin"]), fun))
+        if 'origin' in val and not disable_backlog:
+            chains[key]["backlog"] = Backlog(
+                globify(val["origin"]), fun,
+                partial(was_detected, val.get("topic")),
+                float(val.get('backlog_rate', 0)))
+            backlogs.append(chains[key]["backlog"])
 
         if not identical:
             LOGGER.debug("Updated " + key)
@@ -538,15 +1652,15 @@ def reload_config(filename,
             LOGGER.debug("Added " + key)
 
     for key in (set(chains.keys()) - set(new_chains.keys())):
+        if "backlog" in chains[key]:
+            chains[key]["backlog"].stop()
         chains[key]["notifier"].stop()
         del chains[key]
         LOGGER.debug("Removed " + key)
 
     LOGGER.debug("Reloaded config from " + filename)
-    if old_glob and not disable_backlog:
-        time.sleep(3)
-        for pattern, fun in old_glob:
-            process_old_files(pattern, fun)
+    for backlog in backlogs:
+        backlog.start()
 
     LOGGER.debug("done reloading config")
 
@@ -639,6 +1753,128 @@ def unpack(pathname,
 # Mover
 
 
+class DestinationGuard(object):
+    """Limit the pushes to a destination host, and stop them when it's down.
+
+    At most *max_pushes* pushes (0 for no limit) run at the same time, the
+    others wait up to *wait_timeout* seconds for their turn. After
+    *max_failures* failed pushes in a row (0 to never give up), pushes fail
+    at once for *cooldown* seconds. Then a single push is let through to
+    probe the host: if it succeeds the pushes go on, otherwise they fail for
+    another *cooldown* seconds.
+
+    Chains pushing to the same host share its guard. The settings left out
+    of a chain's configuration don't reset the ones of the others, and when
+    chains disagree the strictest value is used.
+    """
+
+    # Option, default value, and function picking the strictest values
+    options = (('destination_max_pushes', 'max_pushes', int, 0,
+                lambda values: min(val for val in values if val > 0)),
+               ('destination_wait_timeout', 'wait_timeout', float, 60, min),
+               ('destination_max_failures', 'max_failures', int, 0,
+                lambda values: min(val for val in values if val > 0)),
+               ('destination_cooldown', 'cooldown', float, 60, max))
+
+    def __init__(self, name):
+        self.name = name
+        self.max_pushes = 0
+        self.wait_timeout = 60
+        self.max_failures = 0
+        self.cooldown = 60
+        self.pushes = 0
+        self.failures = 0
+        self.opened = None
+        self.probing = False
+        self.condition = Condition()
+        # Settings given by each chain
+        self.settings = {}
+
+    def configure(self, attrs):
+        """Take the limits from the chain configuration *attrs*."""
+        settings = dict((option, convert(attrs[option]))
+                        for option, name, convert, default, strictest
+                        in self.options if option in attrs)
+        with self.condition:
+            if self.settings.get(attrs.get('topic')) == settings:
+                return
+            self.settings[attrs.get('topic')] = settings
+            for option, name, convert, default, strictest in self.options:
+                values = [chain_settings[option]
+                          for chain_settings in self.settings.values()
+                          if option in chain_settings]
+                try:
+                    value = strictest(values)
+                except ValueError:
+                    # Nobody set it, or only to the default
+                    value = default
+                if len(set(values)) > 1:
+                    LOGGER.warning("Chains pushing to %s have different %s, "
+                                   "using %s", self.name, option, str(value))
+                setattr(self, name, value)
+            self.condition.notify_all()
+
+    def __enter__(self):
+        with self.condition:
+            if self.opened is not None:
+                if self.probing:
+                    raise IOError("%s is down, waiting for a probe to "
+                                  "finish" % self.name)
+                remaining = self.opened + self.cooldown - time.time()
+                if remaining > 0:
+                    raise IOError("%s is down, not trying again for %d "
+                                  "seconds" % (self.name, remaining))
+                LOGGER.info("Probing %s", self.name)
+                self.probing = True
+            deadline = time.time() + self.wait_timeout
+            while self.max_pushes > 0 and self.pushes >= self.max_pushes:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.probing = False
+                    raise IOError("Too many pushes to %s already" % self.name)
+                self.condition.wait(remaining)
+            self.pushes += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self.condition:
+            self.pushes -= 1
+            self.condition.notify()
+            if exc_type is None:
+                if self.opened is not None:
+                    LOGGER.info("%s is back up", self.name)
+                self.failures = 0
+                self.opened = None
+                self.probing = False
+                return
+            self.failures += 1
+            if self.probing or (self.max_failures > 0 and
+                                self.failures >= self.max_failures):
+                if self.opened is None:
+                    LOGGER.warning("%d failed pushes to %s in a row, not "
+                                   "trying again for %d seconds",
+                                   self.failures, self.name, self.cooldown)
+                self.opened = time.time()
+                self.probing = False
+
+
+destination_guards = dict()
+destination_guards_lock = Lock()
+
+
+def get_destination_guard(destination, attrs):
+    """Get the guard of the *destination* url's host, set up from *attrs*."""
+    key = (destination.scheme, destination.hostname, destination.port)
+    with destination_guards_lock:
+        try:
+            guard = destination_guards[key]
+        except KeyError:
+            guard = DestinationGuard(clean_url(destination._replace(path='')))
+            destination_guards[key] = guard
+    guard.configure(attrs)
+    return guard
+
+
 def move_it(pathname, destination, attrs=None, hook=None, rel_path=''):
     """Check if the file pointed by *filename* is in the filelist, and move it
     if it is.
@@ -654,9 +1890,23 @@ def move_it(pathname, destination, attrs=None, hook=None, rel_path=''):
         LOGGER.error("Unsupported protocol '" + str(dest_url.scheme) +
                      "'. Could not copy " + pathname + " to " + str(destination))
         raise
+    if dest_url.scheme in ['scp', 'sftp'] and is_local_destination(new_dest):
+        LOGGER.debug("%s is on this host, copying locally", fake_dest)
+        new_dest = new_dest._replace(scheme='file', netloc='')
+        mover = FileMover
 
     try:
-        mover(pathname, new_dest, attrs=attrs).copy()
+        mover = mover(pathname, new_dest, attrs=attrs)
+        # Local copies are neither limited nor stopped
+        with get_destination_guard(
+                new_dest, {} if isinstance(mover, FileMover) else attrs or {}):
+            if ((attrs or {}).get('skip_unchanged', 'False').lower() in
+                    ["1", "yes", "true", "on"] and mover.is_unchanged()):
+                LOGGER.info("Skipping %s, already present in %s",
+                            pathname, str(fake_dest))
+                return
+            mover.copy()
+        mover.remember_copy()
         if hook:
             hook(pathname, new_dest)
     except Exception as err:
@@ -669,27 +1919,291 @@ def move_it(pathname, destination, attrs=None, hook=None, rel_path=''):
         LOGGER.info("Successfully copied " + pathname + " to " + str(
             fake_dest))
 
-# TODO: implement the creation of missing directories.
 
+def is_local_destination(destination):
+    """Check if the *destination* url can be written to directly.
 
-class Mover(object):
-    """Base mover object. Doesn't do anything as it has to be subclassed.
+    That is if it's on this host's ssh port, for the current user, and the
+    destination directory (or its closest existing parent) is writable. Other
+    ports may be forwarded elsewhere, eg. to a container.
     """
+    if destination.username not in (None, getpass.getuser()):
+        return False
+    if destination.port not in (None, 22):
+        return False
+    if not is_local_host(destination.hostname):
+        return False
+    path = os.path.dirname(destination.path)
+    while path and not os.path.exists(path):
+        path = os.path.dirname(path)
+    return os.access(path or '.', os.W_OK)
 
-    def __init__(self, origin, destination, attrs=None):
-        if isinstance(destination, string_types):
-            self.destination = urlparse(destination)
-        else:
-            self.destination = destination
 
-        self.origin = origin
-        self.attrs = attrs or {}
+# TODO: implement the creation of missing directories.
 
-    def copy(self):
-        """Copy it !
-        """
+# Ftp replies refusing a restart (REST) position, eg. past the end of the file
+REST_REFUSED_CODES = ('501', '502', '504', '554')
 
-        raise NotImplementedError("Copy for scheme " + self.destination.scheme
+# Size and number of the samples of a partial upload checked before resuming it
+RESUME_CHECK_SIZE = 65536
+RESUME_SAMPLES = 8
+
+# Size in bytes from which partial uploads are looked for before uploading
+RESUME_THRESHOLD = 10 * 1024 * 1024
+
+
+def resume_samples(size, sample_size=RESUME_CHECK_SIZE, count=RESUME_SAMPLES):
+    """Get the (offset, length) of the samples of a partial upload to check.
+
+    The samples are spread over the *size* bytes of the partial file, the
+    last one ending with it.
+    """
+    if size <= sample_size * count:
+        return [(0, size)]
+    step = (size - sample_size) // (count - 1)
+    return ([(i * step, sample_size) for i in range(count - 1)] +
+            [(size - sample_size, sample_size)])
+
+
+class RangeReader(object):
+    """File-like object reading at most *length* bytes from *file_obj*."""
+
+    def __init__(self, file_obj, length):
+        self.file_obj = file_obj
+        self.remaining = length
+        self.end = file_obj.tell() + length
+
+    def tell(self):
+        return self.file_obj.tell()
+
+    def seek(self, offset):
+        self.file_obj.seek(offset)
+        self.remaining = self.end - offset
+
+    def read(self, size=-1):
+        """Read up to *size* bytes, without going past the end of the range."""
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file_obj.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+class TokenBucket(object):
+    """Let *rate* bytes per second through, in bursts of *burst_time* seconds.
+
+    Callers going over the limit are put to sleep until the bytes they took
+    are paid back, in the order they came.
+    """
+
+    def __init__(self, rate, burst_time=1.0):
+        self.burst_time = burst_time
+        self.rate = float(rate)
+        self.burst = self.rate * burst_time
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self.lock = Lock()
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill()
+            self.rate = float(rate)
+            self.burst = self.rate * self.burst_time
+            self.tokens = min(self.tokens, self.burst)
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def consume(self, amount):
+        """Take *amount* bytes from the bucket, waiting if it is empty."""
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+# Number of seconds a chain keeps its share of a limit after sending data
+BANDWIDTH_SHARE_TIME = 1.0
+
+
+class SharedLimit(object):
+    """Share *rate* bytes per second between chains, according to weights.
+
+    Only the chains that sent data in the last `BANDWIDTH_SHARE_TIME`
+    seconds get a share, so that a chain alone on the link gets all of it.
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.users = dict()
+        self.lock = Lock()
+
+    def consume(self, chain, weight, amount):
+        """Let *chain* send *amount* bytes, waiting for its share if needed."""
+        now = time.time()
+        with self.lock:
+            bucket = self.users.get(chain, (None, ))[0]
+            if bucket is None:
+                bucket = TokenBucket(self.rate)
+            self.users[chain] = (bucket, weight, now)
+            for key, (_, _, stamp) in list(self.users.items()):
+                if now - stamp > BANDWIDTH_SHARE_TIME:
+                    del self.users[key]
+            total = sum(user[1] for user in self.users.values())
+            bucket.set_rate(self.rate * weight / total)
+        bucket.consume(amount)
+
+
+# Bandwidth limits of the destination hosts and chains
+shared_limits = dict()
+shared_limits_rates = dict()
+shared_limits_lock = Lock()
+
+
+def get_bandwidth_limit(key, rate, chain=None):
+    """Get the limit shared under *key*, *chain* asking for *rate* bytes per
+    second.
+
+    Chains asking for different rates for the same key share the lowest one.
+    """
+    with shared_limits_lock:
+        rates = shared_limits_rates.setdefault(key, dict())
+        if rates.get(chain) != rate:
+            others = set(val for other, val in rates.items()
+                         if other != chain)
+            if others and others != set([rate]):
+                LOGGER.warning("Chain %s sets a bandwidth limit of %s for %s,"
+                               " other chains set %s, using the lowest",
+                               str(chain), str(rate), str(key[1]),
+                               ", ".join(str(val) for val in sorted(others)))
+            rates[chain] = rate
+        rate = min(rates.values())
+        limit = shared_limits.get(key)
+        if limit is None:
+            limit = SharedLimit(rate)
+            shared_limits[key] = limit
+        else:
+            limit.rate = float(rate)
+        return limit
+
+
+class ThrottledReader(object):
+    """File-like object reading *file_obj*, slowed down by *throttle*."""
+
+    def __init__(self, file_obj, throttle):
+        self.file_obj = file_obj
+        self.throttle = throttle
+
+    def tell(self):
+        return self.file_obj.tell()
+
+    def seek(self, offset):
+        self.file_obj.seek(offset)
+
+    def read(self, size=-1):
+        data = self.file_obj.read(size)
+        if data:
+            self.throttle(len(data))
+        return data
+
+
+class Mover(object):
+    """Base mover object. Doesn't do anything as it has to be subclassed.
+    """
+
+    # Cached remote directory listings, shared by all movers
+    remote_listings = dict()
+    remote_listings_lock = Lock()
+
+    # (host, target) of the uploads which failed, maybe leaving partial files
+    failed_uploads = set()
+    failed_uploads_lock = Lock()
+
+    def __init__(self, origin, destination, attrs=None):
+        if isinstance(destination, string_types):
+            self.destination = urlparse(destination)
+        else:
+            self.destination = destination
+
+        self.origin = origin
+        self.attrs = attrs or {}
+
+    @property
+    def target(self):
+        """Path of the file written at the destination."""
+        if self.destination.path.endswith('/'):
+            return os.path.join(self.destination.path,
+                                os.path.basename(self.origin))
+        return self.destination.path
+
+    def list_dir(self, dirname):
+        """List the remote *dirname*.
+
+        Return a dictionary of filenames to (size, mtime) tuples.
+        """
+        raise NotImplementedError("Listing for scheme " +
+                                  self.destination.scheme +
+                                  " not implemented (yet).")
+
+    def _listing_key(self, dirname):
+        return (self.destination.scheme, self.destination.hostname,
+                self.destination.port, self.destination.username, dirname)
+
+    def remote_stat(self, path):
+        """Get the (size, mtime) of the remote *path*, None if it is missing.
+
+        Remote directories are listed once and the listing is cached for
+        'remote_listing_ttl' seconds.
+        """
+        dirname, filename = os.path.split(path)
+        key = self._listing_key(dirname)
+        ttl = float(self.attrs.get('remote_listing_ttl', 60))
+        now = time.time()
+        with self.remote_listings_lock:
+            stamp, listing = self.remote_listings.get(key, (0, None))
+        if listing is None or now - stamp > ttl:
+            listing = self.list_dir(dirname)
+            with self.remote_listings_lock:
+                for old_key, (old_stamp, _) in list(self.remote_listings.items()):
+                    if now - old_stamp > ttl:
+                        del self.remote_listings[old_key]
+                self.remote_listings[key] = (now, listing)
+        return listing.get(filename)
+
+    def is_unchanged(self):
+        """Check if the destination already has an identical copy of the origin.
+
+        That is, a file with the same size that was modified after the origin.
+        """
+        origin_stat = os.stat(self.origin)
+        try:
+            remote = self.remote_stat(self.target)
+        except Exception as err:
+            LOGGER.debug("Could not check %s: %s", self.target, str(err))
+            return False
+        return (remote is not None and remote[0] == origin_stat.st_size and
+                remote[1] >= int(origin_stat.st_mtime))
+
+    def remember_copy(self):
+        """Update the cached listing with the file just copied."""
+        dirname, filename = os.path.split(self.target)
+        with self.remote_listings_lock:
+            try:
+                listing = self.remote_listings[self._listing_key(dirname)][1]
+            except KeyError:
+                return
+            listing[filename] = (os.path.getsize(self.origin), time.time())
+
+    def copy(self):
+        """Copy it !
+        """
+
+        raise NotImplementedError("Copy for scheme " + self.destination.scheme
                                   + " not implemented (yet).")
 
     def move(self):
@@ -735,21 +2249,398 @@ class Mover(object):
                         del self.active_connections[key]
                         break
 
+    def acquire_connection(self):
+        """Get an extra connection to the destination, eg. for a chunk.
+
+        Connections given back with :meth:`release_connection` less than
+        'connection_uptime' seconds ago are reused.
+        """
+        key = (self.destination.hostname, self.destination.port,
+               self.destination.username)
+        uptime = int(self.attrs.get('connection_uptime', 30))
+        while True:
+            with self.idle_connection_lock:
+                idle = self.idle_connections.get(key, [])
+                if not idle:
+                    break
+                connection, stamp = idle.pop()
+            if time.time() - stamp <= uptime and self.is_connected(connection):
+                return connection
+            self.close_connection(connection)
+        return self.open_connection()
+
+    def release_connection(self, connection):
+        """Give back a connection got with :meth:`acquire_connection`."""
+        key = (self.destination.hostname, self.destination.port,
+               self.destination.username)
+        with self.idle_connection_lock:
+            self.idle_connections.setdefault(key, []).append(
+                (connection, time.time()))
+
+    def may_resume(self, size):
+        """Check if a partial upload of the origin file, of *size* bytes, is
+        worth looking for.
+
+        It is for files over 'resume_threshold' bytes, and for the ones which
+        failed to upload before. For the others, it would only cost more
+        round trips.
+        """
+        threshold = int(self.attrs.get('resume_threshold', RESUME_THRESHOLD))
+        return (size > threshold or
+                (self.destination.hostname, self.target) in
+                Mover.failed_uploads)
+
+    def upload_failed(self, failed=True):
+        """Remember if the upload of the origin file failed, or not."""
+        key = (self.destination.hostname, self.target)
+        with Mover.failed_uploads_lock:
+            if failed:
+                Mover.failed_uploads.add(key)
+            else:
+                Mover.failed_uploads.discard(key)
+
+    def resume_offset(self, file_obj, remote_size, remote_mtime, read_remote):
+        """Get the offset to resume an interrupted upload of *file_obj* from.
+
+        *remote_size* and *remote_mtime* are the size and modification time
+        of the partially uploaded file, and *read_remote(offset, length)*
+        reads it. The partial file has to be newer than the origin file, and
+        samples spread over it have to match the origin file for the upload
+        to be resumed, otherwise it starts over from 0.
+        """
+        origin_stat = os.fstat(file_obj.fileno())
+        if not remote_size or remote_size > origin_stat.st_size:
+            return 0
+        if remote_mtime is None or remote_mtime < int(origin_stat.st_mtime):
+            LOGGER.info("Partial upload of %s is older than the file, "
+                        "starting over", self.origin)
+            return 0
+        for offset, length in resume_samples(remote_size):
+            file_obj.seek(offset)
+            if read_remote(offset, length) != file_obj.read(length):
+                LOGGER.warning("Partial upload of %s doesn't match, "
+                               "starting over", self.origin)
+                return 0
+        LOGGER.info("Resuming upload of %s from byte %d",
+                    self.origin, remote_size)
+        return remote_size
+
+    def use_chunked_copy(self, size):
+        """Check if a file of *size* bytes should be uploaded in chunks."""
+        threshold = int(self.attrs.get('chunked_upload_threshold', 0))
+        return threshold > 0 and size > threshold
+
+    def chunked_copy(self, path, size, start=0):
+        """Upload the origin file to *path* as byte ranges, in parallel.
+
+        Each range is sent with :meth:`put_range`, which is expected to use a
+        connection of its own. The bytes before *start* are left out.
+        """
+        connections = int(self.attrs.get('chunked_upload_connections', 4))
+        chunk_size = -(-(size - start) // max(connections, 1))
+        errors = []
+
+        def put_range(offset, length):
+            try:
+                self.put_range(path, offset, length)
+            except Exception as err:
+                LOGGER.error("Failed to upload bytes %d-%d of %s: %s",
+                             offset, offset + length - 1, self.origin, str(err))
+                errors.append(err)
+
+        threads = [Thread(target=put_range,
+                          args=(offset, min(chunk_size, size - offset)))
+                   for offset in range(start, size, chunk_size)]
+        LOGGER.debug("Uploading %s in %d chunks", self.origin, len(threads))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def put_range(self, path, offset, length):
+        """Upload *length* bytes of the origin file from *offset* to *path*."""
+        raise NotImplementedError("Chunked copy for scheme " +
+                                  self.destination.scheme +
+                                  " not implemented (yet).")
+
+    def bandwidth_limits(self):
+        """Get the bandwidth limits applying to this transfer."""
+        limits = []
+        for key, option in ((('host', self.destination.hostname),
+                             'bandwidth_limit'),
+                            (('chain', self.attrs.get('topic')),
+                             'chain_bandwidth_limit')):
+            rate = float(self.attrs.get(option, 0))
+            if rate > 0:
+                limits.append(get_bandwidth_limit(key, rate,
+                                                  self.attrs.get('topic')))
+        return limits
+
+    @property
+    def throttled(self):
+        """Check if the transfer has a bandwidth limit."""
+        return bool(self.bandwidth_limits())
+
+    def throttle(self, amount):
+        """Wait until *amount* more bytes may be sent to the destination.
+
+        Chains sharing a limit get a part of it proportional to their
+        'bandwidth_weight'.
+        """
+        weight = float(self.attrs.get('bandwidth_weight', 1))
+        for limit in self.bandwidth_limits():
+            limit.consume(self.attrs.get('topic'), weight, amount)
+
+
+def fsync_path(path):
+    """Flush the file or directory *path* to disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Values of the 'fsync' option
+FSYNC_POLICIES = ('none', 'file', 'batch')
+
+
+class Syncer(Thread):
+    """Flush files to disk in batches.
+
+    The files added are flushed, along with their directories, when
+    *max_files* of them are waiting or *interval* seconds after the first of
+    them was added.
+    """
+
+    def __init__(self, max_files=100, interval=5):
+        Thread.__init__(self)
+        self.daemon = True
+        self.queue = Queue()
+        self.max_files = max_files
+        self.interval = interval
+        self.loop = True
+
+    def add(self, filename):
+        self.queue.put(filename)
+
+    def run(self):
+        pending = []
+        deadline = None
+        while self.loop:
+            if deadline is None:
+                timeout = 2
+            else:
+                timeout = max(deadline - time.time(), 0)
+            try:
+                filename = self.queue.get(True, timeout)
+            except Empty:
+                pass
+            else:
+                if filename is None:
+                    # Woken up to stop
+                    break
+                pending.append(filename)
+                if deadline is None:
+                    deadline = time.time() + self.interval
+            if pending and (len(pending) >= self.max_files or
+                            time.time() >= deadline):
+                self.sync(pending)
+                pending = []
+                deadline = None
+        while True:
+            try:
+                pending.append(self.queue.get_nowait())
+            except Empty:
+                break
+        pending = [filename for filename in pending if filename is not None]
+        if pending:
+            self.sync(pending)
+
+    @staticmethod
+    def sync(filenames):
+        """Flush *filenames* and their directories to disk."""
+        dirnames = set()
+        for filename in filenames:
+            dirnames.add(os.path.dirname(filename))
+            try:
+                fsync_path(filename)
+            except OSError as err:
+                LOGGER.warning("Could not flush %s: %s", filename, str(err))
+        for dirname in dirnames:
+            try:
+                fsync_path(dirname)
+            except OSError as err:
+                LOGGER.warning("Could not flush %s: %s", dirname, str(err))
+        LOGGER.debug("Flushed %d files to disk", len(filenames))
+
+    def stop(self):
+        self.loop = False
+        self.queue.put(None)
+
+
+syncers = {}
+syncers_lock = Lock()
+
+
+def get_syncer(max_files, interval):
+    """Get the running syncer for these batch parameters."""
+    with syncers_lock:
+        try:
+            return syncers[(max_files, interval)]
+        except KeyError:
+            syncer = Syncer(max_files, interval)
+            syncer.start()
+            syncers[(max_files, interval)] = syncer
+            return syncer
+
+
+def stop_syncers():
+    """Stop the syncers, flushing the files still waiting."""
+    with syncers_lock:
+        for syncer in syncers.values():
+            syncer.stop()
+        for syncer in syncers.values():
+            syncer.join()
+        syncers.clear()
+
+
+# ioctl request to share the blocks of a file with another (reflink)
+FICLONE = 0x40049409
+
+# Errors telling that an in-kernel copy isn't possible for these files
+NO_KERNEL_COPY_ERRORS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                         errno.EOPNOTSUPP, errno.ENOTSUP)
+
+
+def copy_file(origin, destination, preallocate=False, throttle=None):
+    """Copy *origin* to *destination*, keeping the data out of user space.
+
+    The file is cloned if the filesystem supports it, otherwise copied by the
+    kernel with copy_file_range or sendfile, and as a last resort with a
+    buffered copy. The destination's space can be preallocated with
+    *preallocate*. Permission bits are copied too, like `shutil.copy` does.
+
+    If *throttle* is given, the file is always copied through a buffer and
+    *throttle* is called with the size of each block before writing it.
+    """
+    with open(origin, 'rb') as src, open(destination, 'wb') as dst:
+        if throttle is None:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except (IOError, OSError):
+                pass
+            else:
+                shutil.copymode(origin, destination)
+                return
+        size = os.fstat(src.fileno()).st_size
+        if preallocate and size and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(dst.fileno(), 0, size)
+            except OSError as err:
+                LOGGER.debug("Could not preallocate %s: %s",
+                             destination, str(err))
+        if throttle is None:
+            copied = kernel_copy(src.fileno(), dst.fileno(), size)
+        else:
+            copied = 0
+            src = ThrottledReader(src, throttle)
+        if copied < size:
+            src.seek(copied)
+            dst.seek(copied)
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+    shutil.copymode(origin, destination)
+
+
+def kernel_copy(src_fd, dst_fd, size):
+    """Copy up to *size* bytes from *src_fd* to *dst_fd* inside the kernel.
+
+    Return the number of bytes copied, which is 0 if the kernel can't do the
+    copy for these files.
+    """
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        copied = _kernel_copy_loop(
+            lambda offset, count: os.copy_file_range(src_fd, dst_fd, count,
+                                                     offset, offset),
+            copied, size)
+    if copied < size and hasattr(os, 'sendfile'):
+        os.lseek(dst_fd, copied, os.SEEK_SET)
+        copied = _kernel_copy_loop(
+            lambda offset, count: os.sendfile(dst_fd, src_fd, offset, count),
+            copied, size)
+    return copied
+
+
+def _kernel_copy_loop(copy_fun, copied, size):
+    start = copied
+    try:
+        while copied < size:
+            sent = copy_fun(copied, min(size - copied, 1024 ** 3))
+            if sent == 0:
+                break
+            copied += sent
+    except OSError as err:
+        if copied > start or err.errno not in NO_KERNEL_COPY_ERRORS:
+            raise
+    return copied
+
 
 class FileMover(Mover):
     """Move files in the filesystem.
     """
 
+    @property
+    def target(self):
+        """Path of the file written at the destination."""
+        if os.path.isdir(self.destination.path):
+            return os.path.join(self.destination.path,
+                                os.path.basename(self.origin))
+        return Mover.target.fget(self)
+
+    def remote_stat(self, path):
+        """Get the (size, mtime) of *path*, None if it is missing."""
+        try:
+            file_stat = os.stat(path)
+        except OSError:
+            return None
+        return file_stat.st_size, file_stat.st_mtime
+
+    def remember_copy(self):
+        """Nothing is cached for local files."""
+        pass
+
     def copy(self):
         """Copy
         """
-        dirname = os.path.dirname(self.destination.path)
+        target = self.target
+        dirname = os.path.dirname(target)
         if not os.path.exists(dirname):
             os.makedirs(dirname)
+        fsync = self.attrs.get('fsync', 'none').lower()
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy '%s', should be one of %s"
+                             % (fsync, ", ".join(FSYNC_POLICIES)))
+        tmp_target = partial_name(target)
+        Deleter.delete(tmp_target)
         try:
-            os.link(self.origin, self.destination.path)
+            os.link(self.origin, tmp_target)
         except OSError:
-            shutil.copy(self.origin, self.destination.path)
+            copy_file(self.origin, tmp_target,
+                      preallocate=self.attrs.get('preallocate', 'False').lower()
+                      in ["1", "yes", "true", "on"],
+                      throttle=self.throttle if self.throttled else None)
+            if fsync == 'file':
+                fsync_path(tmp_target)
+        os.rename(tmp_target, target)
+        if fsync == 'file':
+            fsync_path(dirname)
+        elif fsync == 'batch':
+            get_syncer(int(self.attrs.get('fsync_batch_files', 100)),
+                       float(self.attrs.get('fsync_batch_interval', 5))).add(
+                target)
 
     def move(self):
         """Move it !
@@ -790,6 +2681,10 @@ class FtpMover(Mover):
 
     active_connections = dict()
     active_connection_lock = Lock()
+    idle_connections = dict()
+    idle_connection_lock = Lock()
+    no_chunks_hosts = set()
+    no_mlsd_hosts = set()
 
     def open_connection(self):
         connection = FTP(timeout=10)
@@ -800,6 +2695,8 @@ class FtpMover(Mover):
                              self.destination.password)
         else:
             connection.login()
+        # Remote directories known to exist
+        connection.known_dirs = set()
 
         return connection
 
@@ -833,20 +2730,259 @@ class FtpMover(Mover):
         """
         connection = self.get_connection(self.destination.hostname, self.destination.port, self.destination.username)
 
-        def cd_tree(current_dir):
-            if current_dir != "":
+        dirname = os.path.dirname(self.destination.path)
+        filename = os.path.join(dirname, os.path.basename(self.origin))
+        was_known = dirname in connection.known_dirs
+        self.make_dirs(connection, dirname)
+        try:
+            self.upload(connection, filename)
+        except error_perm:
+            # The directory might have been removed behind our back
+            if not was_known or self._dir_exists(connection, dirname):
+                raise
+            LOGGER.debug('Upload failed, creating %s again', dirname)
+            connection.known_dirs.clear()
+            self.make_dirs(connection, dirname)
+            self.upload(connection, filename)
+
+    @staticmethod
+    def _dir_exists(connection, dirname):
+        try:
+            connection.cwd(dirname)
+        except all_errors:
+            return False
+        return True
+
+    @property
+    def target(self):
+        """Path of the file written at the destination."""
+        return os.path.join(os.path.dirname(self.destination.path),
+                            os.path.basename(self.origin))
+
+    def list_dir(self, dirname):
+        """List the remote *dirname* with MLSD."""
+        host = (self.destination.hostname, self.destination.port)
+        if host in self.no_mlsd_hosts:
+            raise IOError("MLSD not supported by " + self.destination.hostname)
+        connection = self.get_connection(self.destination.hostname,
+                                         self.destination.port,
+                                         self.destination.username)
+        listing = {}
+        try:
+            entries = list(connection.mlsd(dirname or '.',
+                                           facts=['type', 'size', 'modify']))
+        except error_perm as err:
+            if str(err)[:3] in ('500', '502'):
+                LOGGER.warning("%s doesn't support MLSD, files pushed to it "
+                               "are never skipped", self.destination.hostname)
+                self.no_mlsd_hosts.add(host)
+            elif (str(err).startswith('550') or
+                  not self._dir_exists(connection, dirname or '.')):
+                # No such directory
+                return listing
+            raise
+        for name, facts in entries:
+            if facts.get('type', 'file') != 'file' or 'modify' not in facts:
+                continue
+            mtime = calendar.timegm(time.strptime(
+                facts['modify'][:14], '%Y%m%d%H%M%S'))
+            listing[name] = (int(facts['size']), mtime)
+        return listing
+
+    @staticmethod
+    def make_dirs(connection, dirname):
+        """Make sure the remote directory *dirname* exists.
+
+        Directories known to exist are cached on the connection, so uploading
+        to them again doesn't cost any extra command.
+        """
+        if dirname == "" or dirname in connection.known_dirs:
+            return
+        LOGGER.debug('cd to %s', dirname)
+        try:
+            connection.cwd(dirname)
+        except (IOError, error_perm):
+            FtpMover.make_dirs(connection, "/".join(dirname.split("/")[:-1]))
+            connection.mkd(dirname)
+        connection.known_dirs.add(dirname)
+
+    def upload(self, connection, filename):
+        """Upload the origin file to *filename*."""
+        size = os.path.getsize(self.origin)
+        tmp_filename = partial_name(filename)
+        if self.use_chunked_copy(size):
+            try:
+                # The ranges are written into an existing file. It gets the
+                # first byte, as restarting from 0 would truncate it.
+                with open(self.origin, 'rb') as file_obj:
+                    connection.storbinary('STOR ' + tmp_filename,
+                                          RangeReader(file_obj, 1))
+                self.chunked_copy(tmp_filename, size, start=1)
+            except error_perm as err:
+                self._delete_quietly(connection, tmp_filename)
+                if str(err)[:3] not in REST_REFUSED_CODES:
+                    raise
+                LOGGER.warning("Chunked upload refused by %s (%s), "
+                               "uploading %s in one piece",
+                               self.destination.hostname, str(err),
+                               self.origin)
+                self.no_chunks_hosts.add(self.destination.hostname)
+            except Exception:
+                self._delete_quietly(connection, tmp_filename)
+                raise
+            else:
+                self._check_size(connection, tmp_filename, size)
+                self._rename(connection, tmp_filename, filename)
+                return
+        resumable = self.may_resume(size)
+        try:
+            with open(self.origin, 'rb') as file_obj:
+                offset = 0
+                if resumable:
+                    offset = self.resume_offset(
+                        file_obj, self._size(connection, tmp_filename),
+                        self._mtime(connection, tmp_filename),
+                        lambda offset, length: self._read_from(
+                            connection, tmp_filename, offset, length))
+                file_obj.seek(offset)
                 try:
-                    connection.cwd(current_dir)
-                except (IOError, error_perm):
-                    cd_tree("/".join(current_dir.split("/")[:-1]))
-                    connection.mkd(current_dir)
-                    connection.cwd(current_dir)
-
-        LOGGER.debug('cd to %s', os.path.dirname(self.destination.path))
-        cd_tree(os.path.dirname(self.destination.path))
-        with open(self.origin, 'rb') as file_obj:
-            connection.storbinary('STOR ' + os.path.basename(self.origin),
-                                  file_obj)
+                    connection.storbinary('STOR ' + tmp_filename, file_obj,
+                                          self.block_size, self.callback,
+                                          rest=offset or None)
+                except error_perm:
+                    if not offset:
+                        raise
+                    LOGGER.warning("Resuming refused, uploading %s from "
+                                   "start", self.origin)
+                    file_obj.seek(0)
+                    connection.storbinary('STOR ' + tmp_filename, file_obj,
+                                          self.block_size, self.callback)
+            if resumable:
+                self._check_size(connection, tmp_filename, size)
+        except Exception:
+            self.upload_failed()
+            raise
+        self.upload_failed(False)
+        self._rename(connection, tmp_filename, filename)
+
+    @staticmethod
+    def _size(connection, filename):
+        """Get the size of the remote *filename*, None if it can't be found."""
+        try:
+            connection.voidcmd('TYPE I')
+            return connection.size(filename)
+        except all_errors:
+            return None
+
+    def _check_size(self, connection, filename, size):
+        """Check the uploaded *filename* has *size* bytes, if SIZE works."""
+        remote_size = self._size(connection, filename)
+        if remote_size is not None and remote_size != size:
+            self._delete_quietly(connection, filename)
+            raise IOError("Size mismatch after uploading %s: %d instead of "
+                          "%d bytes" % (self.origin, remote_size, size))
+
+    @staticmethod
+    def _mtime(connection, filename):
+        """Get the modification time of the remote *filename*, if possible."""
+        try:
+            reply = connection.sendcmd('MDTM ' + filename)
+            return calendar.timegm(time.strptime(reply.split()[1][:14],
+                                                 '%Y%m%d%H%M%S'))
+        except (all_errors + (IndexError, ValueError)):
+            return None
+
+    @staticmethod
+    def _read_from(connection, filename, offset, length):
+        """Read *length* bytes of the remote *filename* from *offset*."""
+        blocks = []
+        try:
+            connection.voidcmd('TYPE I')
+            data_connection = connection.transfercmd('RETR ' + filename,
+                                                     rest=offset)
+        except all_errors:
+            return None
+        try:
+            while length > 0:
+                block = data_connection.recv(min(length, 65536))
+                if not block:
+                    break
+                blocks.append(block)
+                length -= len(block)
+        except all_errors:
+            return None
+        finally:
+            data_connection.close()
+            try:
+                # The transfer may be reported as aborted
+                connection.voidresp()
+            except all_errors:
+                pass
+        return b''.join(blocks)
+
+    def use_chunked_copy(self, size):
+        """Check if the file should be uploaded in chunks.
+
+        Servers that refused chunks once, e.g. because they don't allow
+        restarting an upload past the end of the file, are not asked again.
+        """
+        return (self.destination.hostname not in self.no_chunks_hosts and
+                Mover.use_chunked_copy(self, size))
+
+    @property
+    def block_size(self):
+        """Size of the blocks sent to the data connection."""
+        return int(self.attrs.get('ftp_block_size', 65536))
+
+    @property
+    def callback(self):
+        """Function throttling the blocks sent, None if there is no limit."""
+        if self.throttled:
+            return lambda block: self.throttle(len(block))
+        return None
+
+    def put_range(self, path, offset, length):
+        """Upload a range of the origin file over a connection of its own."""
+        connection = self.acquire_connection()
+        try:
+            with open(self.origin, 'rb') as file_obj:
+                file_obj.seek(offset)
+                connection.storbinary('STOR ' + path,
+                                      RangeReader(file_obj, length),
+                                      self.block_size, self.callback,
+                                      rest=offset)
+        except Exception:
+            self.close_connection(connection)
+            raise
+        self.release_connection(connection)
+
+    @staticmethod
+    def _rename(connection, from_name, to_name):
+        try:
+            connection.rename(from_name, to_name)
+        except error_perm:
+            # Some servers refuse to rename over an existing file
+            connection.delete(to_name)
+            connection.rename(from_name, to_name)
+
+    @staticmethod
+    def _delete_quietly(connection, filename):
+        try:
+            connection.delete(filename)
+        except all_errors:
+            pass
+
+
+def list_sftp_dir(sftp, dirname):
+    """List *dirname* with the *sftp* client, as filenames to (size, mtime)."""
+    try:
+        entries = sftp.listdir_attr(dirname or '.')
+    except IOError as err:
+        if err.errno == errno.ENOENT:
+            return {}
+        raise
+    return dict((entry.filename, (entry.st_size, entry.st_mtime))
+                for entry in entries if stat.S_ISREG(entry.st_mode or 0))
 
 
 class ScpMover(Mover):
@@ -881,6 +3017,17 @@ class ScpMover(Mover):
             LOGGER.debug("Retrying ssh connect ...")
         raise IOError("Failed to ssh connect after 3 attempts")
 
+    def list_dir(self, dirname):
+        """List the remote *dirname* over sftp."""
+        ssh_connection = self.get_connection(self.destination.hostname,
+                                             self.destination.port,
+                                             self.destination.username)
+        sftp = ssh_connection.open_sftp()
+        try:
+            return list_sftp_dir(sftp, dirname)
+        finally:
+            sftp.close()
+
     @staticmethod
     def is_connected(connection):
         LOGGER.debug("checking ssh connection ... " + str(connection.get_transport().is_active()))
@@ -902,17 +3049,24 @@ class ScpMover(Mover):
         ssh_connection = self.get_connection(self.destination.hostname, self.destination.port, self.destination.username)
 
         try:
-            scp = SCPClient(ssh_connection.get_transport())
+            scp = SCPClient(ssh_connection.get_transport(),
+                            progress=self.progress if self.throttled else None)
         except Exception as e:
             LOGGER.error("Failed to initiate SCPClient: " +str(e))
             ssh_connection.close()
             raise
 
         try:
-            scp.put(self.origin, self.destination.path)
+            target = self.target
+            if target == self.destination.path and self.run_command(
+                    ssh_connection, "test -d " + quote(target))[0] == 0:
+                target = os.path.join(target, os.path.basename(self.origin))
+            tmp_target = partial_name(target)
+            scp.put(self.origin, tmp_target)
         except OSError as osex:
             if osex.errno == 2:
                 LOGGER.error("No such file or directory. File not transfered: %s. Original error message: %s", self.origin, str(osex))
+                return
             else:
                 LOGGER.error("OSError in scp.put: " + str(osex))
                 raise
@@ -924,11 +3078,41 @@ class ScpMover(Mover):
         finally:
             scp.close()
 
+        status, error = self.run_command(
+            ssh_connection, "mv -f " + quote(tmp_target) + " " + quote(target))
+        if status != 0:
+            raise IOError("Could not rename %s to %s: %s" %
+                          (tmp_target, target, error))
+
+    @property
+    def progress(self):
+        """Get an scp progress callback throttling the upload."""
+        sent_bytes = [0]
+
+        def progress(filename, size, sent):
+            self.throttle(sent - sent_bytes[0])
+            sent_bytes[0] = sent
+
+        return progress
+
+    @staticmethod
+    def run_command(ssh_connection, command):
+        """Run *command* on the remote host.
+
+        Return the exit status and the error output.
+        """
+        stdin, stdout, stderr = ssh_connection.exec_command(command)
+        status = stdout.channel.recv_exit_status()
+        return status, stderr.read().decode('utf-8', 'replace').strip()
+
 class SftpMover(Mover):
 
     """Move files over sftp.
     """
 
+    idle_connections = dict()
+    idle_connection_lock = Lock()
+
     def move(self):
         """Push it !"""
         self.copy()
@@ -968,11 +3152,18 @@ class SftpMover(Mover):
         # We found no valid key
         raise IOError("RSA key auth failed!")
 
-    def copy(self):
-        """Push it !"""
+    def open_transport(self):
+        """Open an authenticated transport to the destination."""
         import paramiko
 
-        transport = paramiko.Transport((self.destination.hostname, 22))
+        kwargs = {}
+        if 'sftp_window_size' in self.attrs:
+            kwargs['default_window_size'] = int(self.attrs['sftp_window_size'])
+        if 'sftp_max_packet_size' in self.attrs:
+            kwargs['default_max_packet_size'] = int(
+                self.attrs['sftp_max_packet_size'])
+        transport = paramiko.Transport((self.destination.hostname, 22),
+                                       **kwargs)
         transport.start_client()
 
         self._agent_auth(transport)
@@ -980,24 +3171,572 @@ class SftpMover(Mover):
         if not transport.is_authenticated():
             raise IOError("RSA key auth failed!")
 
-        sftp = transport.open_session()
-        sftp = paramiko.SFTPClient.from_transport(transport)
+        return transport
+
+    def open_connection(self):
+        """Open an sftp session, returned with its transport."""
+        import paramiko
+
+        transport = self.open_transport()
+        return transport, paramiko.SFTPClient.from_transport(transport)
+
+    @staticmethod
+    def is_connected(connection):
+        return connection[0].is_active()
+
+    @staticmethod
+    def close_connection(connection):
+        connection[0].close()
+
+    def copy(self):
+        """Push it !"""
+        connection = self.acquire_connection()
+        sftp = connection[1]
         # sftp.get_channel().settimeout(300)
 
         try:
-            sftp.mkdir(os.path.dirname(self.destination.path))
+            target = self.target
+            try:
+                sftp.mkdir(os.path.dirname(target))
+            except IOError:
+                # Assuming remote directory exist
+                pass
+            size = os.path.getsize(self.origin)
+            tmp_path = partial_name(target)
+            if self.use_chunked_copy(size):
+                with sftp.open(tmp_path, 'wb') as file_obj:
+                    file_obj.truncate(size)
+                try:
+                    self.chunked_copy(tmp_path, size)
+                except Exception:
+                    self._remove_quietly(sftp, tmp_path)
+                    raise
+            else:
+                remote_size, remote_mtime = 0, None
+                if self.may_resume(size):
+                    try:
+                        remote_stat = sftp.stat(tmp_path)
+                        remote_size = remote_stat.st_size
+                        remote_mtime = remote_stat.st_mtime
+                    except IOError:
+                        pass
+                try:
+                    with open(self.origin, 'rb') as src:
+                        offset = self.resume_offset(
+                            src, remote_size, remote_mtime,
+                            lambda offset, length: self._read_from(
+                                sftp, tmp_path, offset, length))
+                        src.seek(offset)
+                        with sftp.open(tmp_path,
+                                       'r+b' if offset else 'wb') as dst:
+                            dst.seek(offset)
+                            self.write_pipelined(src, dst)
+                except Exception:
+                    self.upload_failed()
+                    raise
+                self.upload_failed(False)
+            if sftp.stat(tmp_path).st_size != size:
+                raise IOError("Size mismatch after uploading " + self.origin)
+            self._rename(sftp, tmp_path, target)
+        except Exception:
+            self.close_connection(connection)
+            raise
+        self.release_connection(connection)
+
+    def list_dir(self, dirname):
+        """List the remote *dirname*."""
+        connection = self.acquire_connection()
+        try:
+            listing = list_sftp_dir(connection[1], dirname)
+        except Exception:
+            self.close_connection(connection)
+            raise
+        self.release_connection(connection)
+        return listing
+
+    @staticmethod
+    def _read_from(sftp, path, offset, length):
+        """Read *length* bytes of the remote *path* from *offset*."""
+        with sftp.open(path, 'rb') as file_obj:
+            file_obj.seek(offset)
+            return file_obj.read(length)
+
+    def write_pipelined(self, src, dst, length=None):
+        """Write *src* to the remote file *dst* without waiting for each ack.
+
+        Blocks of 'sftp_block_size' bytes are sent back to back, keeping up
+        to 'sftp_request_window' write requests in flight: each time the
+        window is full, only the acknowledgement of the oldest request is
+        waited for. At most *length* bytes are written if it is given.
+        """
+        block_size = int(self.attrs.get('sftp_block_size', 32768))
+        window = int(self.attrs.get('sftp_request_window', 64))
+        throttled = self.throttled
+        # One write request per block
+        dst.MAX_REQUEST_SIZE = block_size
+        dst.set_pipelined(True)
+        while length is None or length > 0:
+            if length is not None:
+                block_size = min(length, block_size)
+            block = src.read(block_size)
+            if not block:
+                break
+            if throttled:
+                self.throttle(len(block))
+            dst.write(block)
+            while len(dst._reqs) > window:
+                self._wait_for_ack(dst)
+            if length is not None:
+                length -= len(block)
+
+    @staticmethod
+    def _wait_for_ack(dst):
+        """Wait for the acknowledgement of the oldest write to *dst*."""
+        from paramiko.sftp import CMD_STATUS, SFTPError
+
+        msg_type, _ = dst.sftp._read_response(dst._reqs.popleft())
+        if msg_type != CMD_STATUS:
+            raise SFTPError("Expected status")
+
+    def put_range(self, path, offset, length):
+        """Upload a range of the origin file over a transport of its own."""
+        connection = self.acquire_connection()
+        try:
+            with open(self.origin, 'rb') as src, \
+                    connection[1].open(path, 'r+b') as dst:
+                src.seek(offset)
+                dst.seek(offset)
+                self.write_pipelined(src, dst, length)
+        except Exception:
+            self.close_connection(connection)
+            raise
+        self.release_connection(connection)
+
+    @staticmethod
+    def _rename(sftp, from_path, to_path):
+        try:
+            sftp.posix_rename(from_path, to_path)
+        except IOError:
+            # The server lacks the posix-rename extension
+            SftpMover._remove_quietly(sftp, to_path)
+            sftp.rename(from_path, to_path)
+
+    @staticmethod
+    def _remove_quietly(sftp, path):
+        try:
+            sftp.remove(path)
         except IOError:
-            # Assuming remote directory exist
             pass
-        sftp.put(self.origin, self.destination.path)
-        transport.close()
+
+
+class ZmqMover(Mover):
+
+    """Stream files to a client's zmq receiver.
+
+    The file is sent in chunks of 'zmq_chunk_size' bytes, as long as the
+    receiver grants credit for them, so that the sender never gets more than
+    a few chunks ahead of the disk on the other side.
+
+    With 'delta_transfer', the receiver first sends the checksums of the
+    blocks of its copy of the file, and only the data it misses is sent.
+    """
+
+    def move(self):
+        """Push it !"""
+        self.copy()
+        os.remove(self.origin)
+
+    def copy(self):
+        """Push it !"""
+        if self.destination.port is None:
+            raise ValueError("No port given in zmq destination")
+        chunk_size = int(self.attrs.get('zmq_chunk_size', 1024 * 1024))
+        timeout = float(self.attrs.get('zmq_timeout', 30))
+        throttled = self.throttled
+        socket = get_context().socket(DEALER)
+        socket.setsockopt(LINGER, 0)
+        socket.connect("tcp://%s:%d" % (self.destination.hostname,
+                                        self.destination.port))
+        poller = Poller()
+        poller.register(socket, POLLIN)
+
+        def receive():
+            if not poller.poll(timeout * 1000):
+                raise IOError("No answer from " + self.destination.hostname)
+            reply = socket.recv_multipart()
+            if reply[0] == b'error':
+                raise IOError(reply[1].decode('utf-8'))
+            return reply
+
+        try:
+            target = self.target.encode('utf-8')
+            size = str(os.path.getsize(self.origin)).encode()
+            # The receiver checks the file against the announced checksum
+            checksum = announced_checksum(self.attrs.get('topic'),
+                                          self.origin)
+            checksum = checksum.encode() if checksum else b''
+            if self.delta:
+                block_size = int(self.attrs.get('delta_block_size',
+                                                DELTA_BLOCK_SIZE))
+                socket.send_multipart([b'signature', target,
+                                       str(block_size).encode()])
+                signature = unpack_signature(receive()[1])
+                socket.send_multipart([b'open', target, size,
+                                       str(block_size).encode(), checksum])
+            else:
+                socket.send_multipart([b'open', target, size, b'', checksum])
+            credit = int(receive()[1])
+            with open(self.origin, 'rb') as file_obj:
+                if self.delta:
+                    messages = self.delta_messages(file_obj, signature,
+                                                   block_size, chunk_size)
+                else:
+                    messages = self.chunk_messages(file_obj, chunk_size)
+                for message in messages:
+                    while credit == 0:
+                        credit += int(receive()[1])
+                    if throttled and message[0] == b'chunk':
+                        self.throttle(len(message[1]))
+                    socket.send_multipart(message, copy=False)
+                    credit -= 1
+            socket.send_multipart([b'close'])
+            # Credit for the last chunks may come before the final answer
+            while receive()[0] != b'done':
+                pass
+        finally:
+            socket.close()
+
+    @property
+    def delta(self):
+        """Check if only the blocks missing at the destination are sent."""
+        return self.attrs.get('delta_transfer', 'False').lower() in [
+            "1", "yes", "true", "on"]
+
+    @staticmethod
+    def chunk_messages(file_obj, chunk_size):
+        """Get the messages sending the whole *file_obj*."""
+        while True:
+            block = file_obj.read(chunk_size)
+            if not block:
+                return
+            yield [b'chunk', block]
+
+    def delta_messages(self, file_obj, signature, block_size, chunk_size):
+        """Get the messages rebuilding *file_obj* from the destination's copy.
+
+        *signature* holds the checksums of the blocks of the copy.
+        """
+        sent = 0
+        for operation in delta_ops(file_obj, signature, block_size,
+                                   chunk_size):
+            if operation[0] == 'data':
+                sent += len(operation[1])
+                yield [b'chunk', operation[1]]
+            else:
+                yield [b'blocks', str(operation[1]).encode(),
+                       str(operation[2]).encode()]
+        LOGGER.debug("Sent %d bytes of %s, reusing the rest",
+                     sent, self.origin)
+
+
+class S3Mover(Mover):
+
+    """Upload files to an s3 compatible object store.
+
+    Destinations look like s3://access_key:secret_key@bucket/some/path/, the
+    keys being url-quoted. Without them, boto3 looks for credentials itself.
+    Files larger than 's3_multipart_chunksize' are sent as multipart uploads,
+    's3_max_concurrency' parts at a time.
+    """
+
+    clients = dict()
+    clients_lock = Lock()
+
+    def move(self):
+        """Push it !"""
+        self.copy()
+        os.remove(self.origin)
+
+    @property
+    def max_concurrency(self):
+        return int(self.attrs.get('s3_max_concurrency', 10))
+
+    @property
+    def key(self):
+        """Object key of the file in the bucket."""
+        return self.target.lstrip('/')
+
+    def get_client(self):
+        """Get an s3 client for the destination, shared by all uploads.
+
+        The client keeps a pool of 's3_max_concurrency' http connections.
+        """
+        import boto3
+        from botocore.config import Config
+
+        username = self.destination.username
+        password = self.destination.password
+        key = (self.attrs.get('s3_endpoint_url'),
+               self.attrs.get('s3_region'), username, password,
+               self.max_concurrency)
+        with self.clients_lock:
+            if key not in self.clients:
+                self.clients[key] = boto3.client(
+                    's3',
+                    endpoint_url=key[0],
+                    region_name=key[1],
+                    aws_access_key_id=username and unquote(username),
+                    aws_secret_access_key=password and unquote(password),
+                    config=Config(max_pool_connections=self.max_concurrency))
+            return self.clients[key]
+
+    def copy(self):
+        """Push it !"""
+        from boto3.s3.transfer import TransferConfig
+
+        chunk_size = int(self.attrs.get('s3_multipart_chunksize',
+                                        8 * 1024 * 1024))
+        config = TransferConfig(multipart_threshold=chunk_size,
+                                multipart_chunksize=chunk_size,
+                                max_concurrency=self.max_concurrency)
+        # Objects only appear once the upload is complete, so there is no
+        # need for a temporary name.
+        self.get_client().upload_file(
+            self.origin, self.destination.hostname, self.key, Config=config,
+            Callback=self.throttle if self.throttled else None)
+
+    def list_dir(self, dirname):
+        prefix = dirname.strip('/')
+        if prefix:
+            prefix += '/'
+        paginator = self.get_client().get_paginator('list_objects_v2')
+        listing = {}
+        for page in paginator.paginate(Bucket=self.destination.hostname,
+                                       Prefix=prefix, Delimiter='/'):
+            for obj in page.get('Contents', []):
+                listing[obj['Key'][len(prefix):]] = (
+                    obj['Size'],
+                    calendar.timegm(obj['LastModified'].utctimetuple()))
+        return listing
+
+
+class HttpMover(Mover):
+
+    """Upload files with http(s) PUT, or to a WebDAV server.
+
+    Connections are kept alive and shared between uploads to the same host,
+    so several files can be uploaded to it in parallel.
+
+    With the dav and davs schemes, missing directories are created (MKCOL)
+    and files are uploaded under a temporary name, then moved into place.
+    Large files can also be uploaded as parallel byte ranges (PUT with
+    Content-Range). Plain http has no way of renaming files, so there files
+    are written directly under their final name.
+    """
+
+    # Remote directories known to exist
+    known_dirs = set()
+    known_dirs_lock = Lock()
+    no_chunks_hosts = set()
+
+    PROPFIND_BODY = (b'<?xml version="1.0" encoding="utf-8"?>'
+                     b'<propfind xmlns="DAV:"><prop>'
+                     b'<getcontentlength/><getlastmodified/>'
+                     b'</prop></propfind>')
+
+    OK = (200, 201, 204)
+
+    def move(self):
+        """Push it !"""
+        self.copy()
+        os.remove(self.origin)
+
+    @property
+    def secure(self):
+        return self.destination.scheme in ['https', 'davs']
+
+    @property
+    def webdav(self):
+        return self.destination.scheme in ['dav', 'davs']
+
+    @property
+    def host(self):
+        return (self.destination.hostname, self.destination.port)
+
+    def url(self, path):
+        """Get the http url of *path* on the destination, without login."""
+        netloc = self.destination.hostname
+        if self.destination.port:
+            netloc += ":" + str(self.destination.port)
+        return urlunparse(('https' if self.secure else 'http', netloc,
+                           quote_url(path), "", "", ""))
+
+    def request(self, method, path, expected=None, headers=None, body=None,
+                dst=None):
+        """Send a *method* request for *path* and return the response.
+
+        IOError is raised if the response status isn't in *expected*.
+        """
+        all_headers = {}
+        if self.destination.username:
+            credentials = "%s:%s" % (unquote(self.destination.username),
+                                     unquote(self.destination.password or ''))
+            all_headers['Authorization'] = 'Basic ' + base64.b64encode(
+                credentials.encode('utf-8')).decode('ascii')
+        all_headers.update(headers or {})
+        pool = get_http_pool(self.destination.hostname, self.destination.port,
+                             self.secure)
+        response = pool.request(method, path, all_headers, body, dst)
+        if expected is not None and response.status not in expected:
+            raise IOError("%s %s failed: %d %s" % (
+                method, self.url(path), response.status, response.reason))
+        return response
+
+    def put(self, path, expected=None, empty=False):
+        """Stream the origin file to *path*, or create it *empty*."""
+        if empty:
+            return self.request('PUT', path, expected,
+                                headers={'Content-Length': '0'}, body=b'')
+        with open(self.origin, 'rb') as file_obj:
+            size = os.fstat(file_obj.fileno()).st_size
+            return self.request('PUT', path, expected,
+                                headers={'Content-Length': str(size)},
+                                body=self.throttled_body(file_obj))
+
+    def throttled_body(self, file_obj):
+        """Slow down the reading of *file_obj* if the bandwidth is limited."""
+        if self.throttled:
+            return ThrottledReader(file_obj, self.throttle)
+        return file_obj
+
+    def copy(self):
+        """Push it !"""
+        target = self.target
+        if not self.webdav:
+            self.put(target, self.OK)
+            return
+        dirname = os.path.dirname(target)
+        tmp_target = partial_name(target)
+        was_known = self.is_known_dir(dirname)
+        self.make_dirs(dirname)
+        response = self.upload(tmp_target)
+        if response.status == 409 and was_known:
+            # The directory might have been removed behind our back
+            LOGGER.debug('Upload failed, checking %s again', dirname)
+            self.forget_dirs()
+            self.make_dirs(dirname)
+            response = self.upload(tmp_target)
+        if response.status not in self.OK:
+            raise IOError("PUT %s failed: %d %s" % (
+                self.url(tmp_target), response.status, response.reason))
+        self.request('MOVE', tmp_target, (201, 204),
+                     headers={'Destination': self.url(target),
+                              'Overwrite': 'T'})
+
+    def upload(self, path):
+        """Upload the origin file to *path*.
+
+        Return the response to the PUT creating the file.
+        """
+        size = os.path.getsize(self.origin)
+        if not self.use_chunked_copy(size):
+            return self.put(path)
+        response = self.put(path, empty=True)
+        if response.status not in self.OK:
+            return response
+        try:
+            self.chunked_copy(path, size)
+        except IOError:
+            if self.host not in self.no_chunks_hosts:
+                raise
+            LOGGER.warning("%s doesn't accept byte ranges, "
+                           "uploading in one piece", self.url(path))
+            return self.put(path)
+        remote_size = self.request('HEAD', path, (200, )).getheader(
+            'Content-Length')
+        if remote_size != str(size):
+            raise IOError("Size mismatch for %s: %s instead of %d bytes" % (
+                self.url(path), remote_size, size))
+        return response
+
+    def use_chunked_copy(self, size):
+        return (self.host not in self.no_chunks_hosts and
+                Mover.use_chunked_copy(self, size))
+
+    def put_range(self, path, offset, length):
+        size = os.path.getsize(self.origin)
+        with open(self.origin, 'rb') as file_obj:
+            file_obj.seek(offset)
+            response = self.request(
+                'PUT', path,
+                headers={'Content-Length': str(length),
+                         'Content-Range': 'bytes %d-%d/%d' % (
+                             offset, offset + length - 1, size)},
+                body=self.throttled_body(RangeReader(file_obj, length)))
+        if response.status in (400, 501):
+            # Servers not supporting partial PUTs have to answer 400
+            self.no_chunks_hosts.add(self.host)
+        if response.status not in self.OK:
+            raise IOError("PUT %s failed: %d %s" % (
+                self.url(path), response.status, response.reason))
+
+    def is_known_dir(self, dirname):
+        with self.known_dirs_lock:
+            return self.host + (dirname.rstrip('/'), ) in self.known_dirs
+
+    def forget_dirs(self):
+        """Forget the directories known to exist on the destination host."""
+        with self.known_dirs_lock:
+            for key in list(self.known_dirs):
+                if key[:2] == self.host:
+                    self.known_dirs.discard(key)
+
+    def make_dirs(self, dirname):
+        """Create *dirname* and its parents if they are not known to exist."""
+        path = ''
+        for part in dirname.strip('/').split('/'):
+            if not part:
+                continue
+            path += '/' + part
+            if self.is_known_dir(path):
+                continue
+            # 405 means the directory is already there
+            self.request('MKCOL', path + '/', (201, 405))
+            with self.known_dirs_lock:
+                self.known_dirs.add(self.host + (path, ))
+
+    def list_dir(self, dirname):
+        if not self.webdav:
+            return Mover.list_dir(self, dirname)
+        content = BytesIO()
+        self.request('PROPFIND', dirname.rstrip('/') + '/', (207, ),
+                     headers={'Depth': '1', 'Content-Type': 'application/xml'},
+                     body=self.PROPFIND_BODY, dst=content)
+        listing = {}
+        for response in ElementTree.fromstring(content.getvalue()).findall(
+                '{DAV:}response'):
+            size = response.findtext('.//{DAV:}getcontentlength')
+            mtime = response.findtext('.//{DAV:}getlastmodified')
+            if not size or not mtime:
+                # Collections
+                continue
+            path = unquote(urlparse(response.findtext('{DAV:}href')).path)
+            listing[os.path.basename(path)] = (int(size),
+                                               mktime_tz(parsedate_tz(mtime)))
+        return listing
 
 
 MOVERS = {'ftp': FtpMover,
           'file': FileMover,
           '': FileMover,
           'scp': ScpMover,
-          'sftp': SftpMover
+          'sftp': SftpMover,
+          'zmq': ZmqMover,
+          's3': S3Mover,
+          'http': HttpMover,
+          'https': HttpMover,
+          'dav': HttpMover,
+          'davs': HttpMover
           }
 
 
@@ -1005,6 +3744,14 @@ MOVERS = {'ftp': FtpMover,
 # fixme: on deletion, the file should be removed from the filecache
 class EventHandler(pyinotify.ProcessEvent):
     """Handle events with a generic *fun* function.
+
+    With *coalesce* seconds, the events about the same file (same inode and
+    path) coming within that time of the first one are dropped if the file's
+    size and mtime didn't change meanwhile, so that one version of a file is
+    handled only once. They are counted in :attr:`suppressed`.
+
+    With a *subdirs* function, the directories created or removed are passed
+    to it instead, with True or False.
     """
 
     def __init__(self, fun, *args, **kwargs):
@@ -1013,49 +3760,163 @@ class EventHandler(pyinotify.ProcessEvent):
         if self._cmd_filename:
             self._cmd_filename = os.path.abspath(self._cmd_filename)
         self._fun = fun
+        self._overflow = kwargs.get('overflow')
+        self._coalesce = kwargs.get('coalesce', 0)
+        self._subdirs = kwargs.get('subdirs')
+        # Time of the first event of the (inode, path) in the window, and
+        # (size, mtime) of the file then
+        self._recent = OrderedDict()
+        self.suppressed = 0
+
+    def _is_duplicate(self, pathname, stats=None):
+        if not self._coalesce:
+            return False
+        if stats is None:
+            try:
+                stats = os.stat(pathname)
+            except OSError:
+                pass
+        if stats is None:
+            key, version = (None, pathname), None
+        else:
+            key = (stats.st_ino, pathname)
+            version = (stats.st_size, stats.st_mtime)
+        now = time.time()
+        while self._recent:
+            first_key, (first, first_version) = next(iter(self._recent.items()))
+            if now - first < self._coalesce:
+                break
+            del self._recent[first_key]
+        if key in self._recent and self._recent[key][1] == version:
+            self.suppressed += 1
+            LOGGER.debug("Duplicate event for %s", pathname)
+            return True
+        # A new version of the file starts a new window
+        self._recent.pop(key, None)
+        self._recent[key] = (now, version)
+        return False
 
     def process_IN_CLOSE_WRITE(self, event):
         """On closing after writing."""
         if self._cmd_filename and os.path.abspath(
                 event.pathname) != self._cmd_filename:
             return
-        self._fun(event.pathname)
+        if not self._is_duplicate(event.pathname):
+            self._fun(event.pathname)
+
+    def _is_subdir(self, event, created):
+        """Pass the directory events on to the *subdirs* function."""
+        if not (event.dir and self._subdirs):
+            return False
+        self._subdirs(event.pathname, created)
+        return True
 
     def process_IN_CREATE(self, event):
         """On closing after linking."""
         if self._cmd_filename and os.path.abspath(
                 event.pathname) != self._cmd_filename:
             return
+        if self._is_subdir(event, True):
+            return
         try:
-            if os.stat(event.pathname).st_nlink > 1:
-                self._fun(event.pathname)
+            stats = os.stat(event.pathname)
         except OSError:
             return
+        if (stats.st_nlink > 1 and
+                not self._is_duplicate(event.pathname, stats)):
+            self._fun(event.pathname)
 
     def process_IN_MOVED_TO(self, event):
         """On closing after moving."""
         if self._cmd_filename and os.path.abspath(
                 event.pathname) != self._cmd_filename:
             return
-        self._fun(event.pathname)
+        if self._is_subdir(event, True):
+            return
+        if not self._is_duplicate(event.pathname):
+            self._fun(event.pathname)
+
+    def process_IN_DELETE(self, event):
+        """On removing."""
+        self._is_subdir(event, False)
+
+    def process_IN_MOVED_FROM(self, event):
+        """On moving away."""
+        self._is_subdir(event, False)
+
+    def process_IN_Q_OVERFLOW(self, event):
+        """On losing events."""
+        LOGGER.warning("Inotify events were lost")
+        if self._overflow:
+            self._overflow()
 
 
-def process_old_files(pattern, fun):
-    fnames = glob.glob(pattern)
-    if fnames:
-        # time.sleep(3)
-        LOGGER.debug("Touching old files")
-        for fname in fnames:
-            if os.path.exists(fname):
-                fun(fname)
+class Backlog(Thread):
+    """Pass the files matching *pattern* that are not *known* yet to *fun*,
+    in the background.
+
+    The newest files go first, at most *rate* files per second (0 for no
+    limit), so that the live files are not held back for long.
+    """
+
+    def __init__(self, pattern, fun, known, rate=0):
+        super(Backlog, self).__init__()
+        self.daemon = True
+        self.pattern = pattern
+        self.fun = fun
+        self.known = known
+        self.bucket = TokenBucket(rate) if rate else None
+        self.loop = Event()
+
+    def old_files(self):
+        """Get the files not known yet, newest first."""
+        matcher = re.compile(fnmatch.translate(self.pattern))
+        files = []
+        for dirname in glob.glob(os.path.dirname(self.pattern)):
+            for name, pathname, is_file in scan_entries(dirname):
+                if self.loop.is_set():
+                    return []
+                if not matcher.match(pathname) or self.known(pathname):
+                    continue
+                try:
+                    stats = os.stat(pathname)
+                except OSError:
+                    continue
+                if stat.S_ISREG(stats.st_mode):
+                    files.append((stats.st_mtime, pathname))
+        files.sort(reverse=True)
+        return [pathname for mtime, pathname in files]
+
+    def run(self):
+        files = self.old_files()
+        LOGGER.debug("%d old files for %s", len(files), self.pattern)
+        for pathname in files:
+            if self.loop.is_set():
+                break
+            if self.bucket is not None:
+                self.bucket.consume(1)
+            # They may have been picked up or removed meanwhile
+            if os.path.exists(pathname) and not self.known(pathname):
+                try:
+                    self.fun(pathname)
+                except Exception:
+                    LOGGER.exception("Could not process %s:", pathname)
+
+    def stop(self):
+        self.loop.set()
 
 
 def terminate(chains, publisher=None):
     for chain in chains.values():
+        if "backlog" in chain:
+            chain["backlog"].stop()
         chain["notifier"].stop()
         if "request_manager" in chain:
             chain["request_manager"].stop()
 
+    file_watcher.stop()
+    stop_syncers()
+
     if publisher:
         publisher.stop()
 
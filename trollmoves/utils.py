@@ -19,11 +19,38 @@
 
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import hashlib
+import mmap
+import os
+import shutil
+import socket
+import struct
+import time
+import zlib
+from threading import Lock
+
 import netifaces
+from six.moves.http_client import (HTTPConnection, HTTPException,
+                                   HTTPSConnection)
+from six.moves.urllib.parse import quote
+
+# Number of seconds the local ips are cached for
+LOCAL_IPS_TTL = 60
+_local_ips = (0, [])
+
+# Size of the blocks sent and received over http
+HTTP_BLOCK_SIZE = 1024 * 1024
 
 
 def get_local_ips():
-    """Get the ips of the current machine."""
+    """Get the ips of the current machine.
+
+    The ips are cached for `LOCAL_IPS_TTL` seconds.
+    """
+    global _local_ips
+    stamp, ips = _local_ips
+    if time.time() - stamp < LOCAL_IPS_TTL:
+        return ips
     inet_addrs = [netifaces.ifaddresses(iface).get(netifaces.AF_INET)
                   for iface in netifaces.interfaces()]
     ips = []
@@ -31,9 +58,317 @@ def get_local_ips():
         if addr is not None:
             for add in addr:
                 ips.append(add['addr'])
+    _local_ips = (time.time(), ips)
     return ips
 
 
+def is_local_host(hostname):
+    """Check if *hostname* resolves to one of the ips of the current machine."""
+    try:
+        return socket.gethostbyname(hostname) in get_local_ips()
+    except socket.error:
+        return False
+
+
+def partial_name(filename):
+    """Get the temporary name *filename* is written to before being renamed."""
+    dirname, basename = os.path.split(filename)
+    return os.path.join(dirname, "." + basename + ".part")
+
+
+class HttpConnectionPool(object):
+    """Keep-alive http(s) connections to *host*, reused between requests."""
+
+    def __init__(self, host, port=None, timeout=60, secure=False):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.secure = secure
+        self._connections = []
+        self._lock = Lock()
+
+    def connect(self):
+        if self.secure:
+            connection = HTTPSConnection(self.host, self.port,
+                                         timeout=self.timeout)
+        else:
+            connection = HTTPConnection(self.host, self.port,
+                                        timeout=self.timeout)
+        connection.blocksize = HTTP_BLOCK_SIZE
+        return connection
+
+    def request(self, method, path, headers=None, body=None, dst=None):
+        """Send a request for *path* and return the response.
+
+        *body* can be a file object, which is then streamed. The body of
+        successful responses is copied to the *dst* file object, otherwise it
+        is discarded.
+        """
+        with self._lock:
+            pooled = self._connections.pop() if self._connections else None
+        offsets = [obj.tell() if hasattr(obj, 'seek') else None
+                   for obj in (body, dst)]
+        # A kept alive connection may have been closed by the server since
+        # its last request, so retry once on a new one.
+        for connection in ([pooled, None] if pooled else [None]):
+            if connection is None:
+                connection = self.connect()
+            try:
+                connection.request(method, quote(path), body,
+                                   headers=headers or {})
+                response = connection.getresponse()
+                if dst is not None and 200 <= response.status < 300:
+                    shutil.copyfileobj(response, dst, HTTP_BLOCK_SIZE)
+                else:
+                    response.read()
+                break
+            except (IOError, HTTPException):
+                connection.close()
+                if connection is not pooled:
+                    raise
+                for obj, offset in zip((body, dst), offsets):
+                    if offset is not None:
+                        obj.seek(offset)
+        if response.will_close:
+            connection.close()
+        else:
+            with self._lock:
+                self._connections.append(connection)
+        return response
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+
+
+_http_pools = {}
+_http_pools_lock = Lock()
+
+
+def get_http_pool(host, port=None, secure=False):
+    """Get the shared pool of connections to the http server at *host*."""
+    with _http_pools_lock:
+        key = (host, port, secure)
+        if key not in _http_pools:
+            _http_pools[key] = HttpConnectionPool(host, port, secure=secure)
+        return _http_pools[key]
+
+
+def close_http_pools():
+    """Close the idle connections of all the http pools."""
+    with _http_pools_lock:
+        for pool in _http_pools.values():
+            pool.close()
+
+
+class Checksum(object):
+    """Running checksum of some data.
+
+    *algorithm* is one of the `hashlib` algorithms, or 'crc32' or 'adler32'
+    for faster but weaker checks. The checksum reads as 'algorithm:hexdigest'.
+    """
+
+    def __init__(self, algorithm):
+        self.algorithm = algorithm.lower()
+        if self.algorithm in ('crc32', 'adler32'):
+            self._fun = getattr(zlib, self.algorithm)
+            self._value = zlib.adler32(b'') if self.algorithm == 'adler32' else 0
+            self._hash = None
+        else:
+            self._hash = hashlib.new(self.algorithm)
+
+    def update(self, data):
+        if self._hash is None:
+            self._value = self._fun(data, self._value)
+        else:
+            self._hash.update(data)
+
+    def hexdigest(self):
+        if self._hash is None:
+            return '%08x' % (self._value & 0xffffffff)
+        return self._hash.hexdigest()
+
+    def __str__(self):
+        return self.algorithm + ':' + self.hexdigest()
+
+
+def new_checksum(checksum):
+    """Start computing a checksum like *checksum* ('algorithm:hexdigest')."""
+    return Checksum(checksum.split(':', 1)[0])
+
+
+def file_checksum(pathname, algorithm):
+    """Get the *algorithm* checksum of the file *pathname*.
+
+    The file is mapped in memory instead of being copied to buffers, so it
+    is read straight from the page cache.
+    """
+    checksum = Checksum(algorithm)
+    with open(pathname, 'rb') as file_obj:
+        if os.fstat(file_obj.fileno()).st_size:
+            mapped = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if hasattr(mapped, 'madvise'):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                checksum.update(mapped)
+            finally:
+                mapped.close()
+    return str(checksum)
+
+
+class ChecksumWriter(object):
+    """File-like object writing to *file_obj*, and updating *checksum*."""
+
+    def __init__(self, file_obj, checksum):
+        self.file_obj = file_obj
+        self.checksum = checksum
+        self.start = file_obj.tell()
+
+    def tell(self):
+        return self.file_obj.tell()
+
+    def seek(self, offset):
+        if offset != self.start:
+            raise IOError("Can only go back to the start of the checksum")
+        self.file_obj.seek(offset)
+        self.checksum = new_checksum(str(self.checksum))
+
+    def write(self, data):
+        self.checksum.update(data)
+        return self.file_obj.write(data)
+
+    def close(self):
+        self.file_obj.close()
+
+
+# Size of the blocks whose checksums are compared for delta transfers
+DELTA_BLOCK_SIZE = 32768
+
+# Size of the data read at once when looking for matching blocks
+DELTA_READ_SIZE = 1024 * 1024
+
+_SIGNATURE_ENTRY = struct.Struct('!I16s')
+
+
+def weak_checksum(data):
+    """Get the rolling (adler-32) checksum of *data*."""
+    return zlib.adler32(bytes(data)) & 0xffffffff
+
+
+def roll_checksum(checksum, removed, added, block_size):
+    """Move the window of *checksum* one byte forward.
+
+    *removed* is the byte leaving the window of *block_size* bytes, and
+    *added* the one entering it.
+    """
+    low = checksum & 0xffff
+    high = checksum >> 16
+    low = (low - removed + added) % 65521
+    high = (high - block_size * removed + low - 1) % 65521
+    return (high << 16) | low
+
+
+def strong_checksum(data):
+    return hashlib.md5(data).digest()
+
+
+def file_signature(file_obj, block_size=DELTA_BLOCK_SIZE):
+    """Get the (weak, strong) checksums of each block of *file_obj*."""
+    signature = []
+    while True:
+        block = file_obj.read(block_size)
+        if not block:
+            return signature
+        signature.append((weak_checksum(block), strong_checksum(block)))
+
+
+def pack_signature(signature):
+    return b''.join(_SIGNATURE_ENTRY.pack(weak, strong)
+                    for weak, strong in signature)
+
+
+def unpack_signature(data):
+    size = _SIGNATURE_ENTRY.size
+    return [_SIGNATURE_ENTRY.unpack(data[offset:offset + size])
+            for offset in range(0, len(data), size)]
+
+
+def delta_ops(file_obj, signature, block_size=DELTA_BLOCK_SIZE,
+              max_literal=DELTA_READ_SIZE):
+    """Get the operations rebuilding *file_obj* from a file of *signature*.
+
+    This is the rsync algorithm: the window of *block_size* bytes is rolled
+    over *file_obj* until its checksums match a block of the other file.
+    Yield ('data', bytes) for the data missing in the other file, at most
+    *max_literal* bytes at a time, and ('blocks', first, count) for runs of
+    blocks to copy from it.
+    """
+    blocks = {}
+    for index, (weak, strong) in enumerate(signature):
+        blocks.setdefault(weak, {}).setdefault(strong, index)
+    if not blocks:
+        while True:
+            data = file_obj.read(max_literal)
+            if not data:
+                return
+            yield ('data', data)
+    data = bytearray(file_obj.read(DELTA_READ_SIZE))
+    start = pos = 0
+    checksum = None
+    run = None
+    while True:
+        if len(data) - pos < block_size:
+            more = file_obj.read(DELTA_READ_SIZE)
+            if more:
+                del data[:start]
+                pos -= start
+                start = 0
+                data.extend(more)
+                continue
+            if len(data) - pos < block_size:
+                break
+        if checksum is None:
+            checksum = weak_checksum(data[pos:pos + block_size])
+        index = None
+        if checksum in blocks:
+            index = blocks[checksum].get(
+                strong_checksum(data[pos:pos + block_size]))
+        if index is not None:
+            if pos > start:
+                if run:
+                    yield ('blocks', ) + tuple(run)
+                    run = None
+                yield ('data', bytes(data[start:pos]))
+            if run and run[0] + run[1] == index:
+                run[1] += 1
+            else:
+                if run:
+                    yield ('blocks', ) + tuple(run)
+                run = [index, 1]
+            pos += block_size
+            start = pos
+            checksum = None
+            continue
+        if pos + block_size < len(data):
+            checksum = roll_checksum(checksum, data[pos],
+                                     data[pos + block_size], block_size)
+        else:
+            checksum = None
+        pos += 1
+        if pos - start >= max_literal:
+            if run:
+                yield ('blocks', ) + tuple(run)
+                run = None
+            yield ('data', bytes(data[start:pos]))
+            start = pos
+    if run:
+        yield ('blocks', ) + tuple(run)
+    for offset in range(start, len(data), max_literal):
+        yield ('data', bytes(data[offset:offset + max_literal]))
+
+
 def gen_dict_extract(var, key):
     if hasattr(var, 'items'):
         for k, v in var.items():